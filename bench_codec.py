@@ -0,0 +1,45 @@
+"""Per-message encode/decode cost of the websocket JSON codecs.
+
+usage: python bench_codec.py [room_size]
+"""
+import sys
+import timeit
+
+from server import JsonCodec, OrjsonCodec, orjson
+
+
+def payloads(room_size: int) -> dict:
+    users = [{"name": f"user{i}", "is_admin": i == 0} for i in range(room_size)]
+    return {
+        "chat": {"user": "alice", "text": "hey everyone, the deploy is done 🎉 https://example.com/notes"},
+        "system": {"user": "system", "text": "alice, bob and carol joined the room"},
+        "users_delta": {"type": "users_delta", "version": 42, "add": users[:3], "remove": ["dave"]},
+        "users": {"type": "users", "users": users, "version": 42},
+    }
+
+
+def bench(codec, obj, number: int) -> tuple:
+    raw = codec.encode(obj)
+    enc = min(timeit.repeat(lambda: codec.encode(obj), number=number, repeat=5)) / number
+    dec = min(timeit.repeat(lambda: codec.decode(raw), number=number, repeat=5)) / number
+    return enc * 1e6, dec * 1e6, len(raw.encode())
+
+
+def main() -> None:
+    room_size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    codecs = [JsonCodec()]
+    if orjson is not None:
+        codecs.append(OrjsonCodec())
+    else:
+        print("orjson not installed; only the stdlib codec is measured")
+
+    print(f"{'payload':<12} {'codec':<8} {'encode us':>10} {'decode us':>10} {'bytes':>8}")
+    for label, obj in payloads(room_size).items():
+        number = 200 if label == "users" else 20000
+        for c in codecs:
+            enc, dec, size = bench(c, obj, number)
+            print(f"{label:<12} {c.name:<8} {enc:>10.2f} {dec:>10.2f} {size:>8}")
+
+
+if __name__ == "__main__":
+    main()
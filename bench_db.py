@@ -0,0 +1,66 @@
+"""Connect-path room lookup latency: a fresh sqlite3 connection per query, the pooled
+per-thread connection, and the in-memory room catalog that room_exists() now uses.
+
+Runs against a throwaway copy of the schema, never data.db.
+usage: python bench_db.py [rooms]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import server
+
+
+def per_call_room_exists(name: str) -> bool:
+    # what room_exists did before connections were pooled
+    conn = sqlite3.connect(server.DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        cur = conn.execute("SELECT 1 FROM rooms WHERE name = ? LIMIT 1", (name,))
+        return cur.fetchone() is not None
+    finally:
+        conn.close()
+
+
+def pooled_room_exists(name: str) -> bool:
+    cur = server.get_db_connection().execute("SELECT 1 FROM rooms WHERE name = ? LIMIT 1", (name,))
+    return cur.fetchone() is not None
+
+
+def measure(fn, names: list) -> list:
+    samples = []
+    for name in names:
+        t0 = time.perf_counter()
+        fn(name)
+        samples.append((time.perf_counter() - t0) * 1e6)
+    samples.sort()
+    return samples
+
+
+def report(label: str, samples: list) -> None:
+    p50 = samples[len(samples) // 2]
+    p99 = samples[int(len(samples) * 0.99)]
+    print(f"{label:<22} p50 {p50:8.1f} us   p99 {p99:8.1f} us")
+
+
+def main() -> None:
+    rooms = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    server.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    server.init_db()
+    conn = server.get_db_connection()
+    with conn:
+        conn.executemany("INSERT INTO rooms (name) VALUES (?)", ((f"room-{i}",) for i in range(rooms)))
+
+    names = [f"room-{i * 7919 % rooms}" for i in range(5000)]
+    report("connect per call", measure(per_call_room_exists, names))
+    report("pooled connection", measure(pooled_room_exists, names))
+    server.room_catalog.refresh(force=True)
+    report("room catalog", measure(server.room_exists, names))
+    server.room_catalog.close()
+    server.close_db_connections()
+
+
+if __name__ == "__main__":
+    main()
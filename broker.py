@@ -0,0 +1,198 @@
+"""Backplane broker for running the chat server as several worker processes.
+
+Each uvicorn worker connects over a Unix-domain socket, subscribes to the rooms it has
+connections in, and publishes room events (chat, presence, admin actions). The broker
+forwards every published line unchanged to the other workers subscribed to that room,
+relays "send" lines to the one worker they name (a room's owner) and "all" lines to every
+other worker (cluster-wide admin actions such as a drain), and keeps every worker up to
+date on the member list so they agree on room ownership.
+
+It is also the cluster's username registry. A worker claims a name with one message and
+only hears back if the claim is denied; every grant and release is pushed to all workers,
+so each one can turn away names held elsewhere without asking. Names are leased: they
+stay held while their worker heartbeats, and are released LEASE_TTL seconds after the
+last heartbeat or as soon as the worker disconnects.
+
+Protocol: newline-delimited JSON objects, worker -> broker:
+    {"op": "hello", "worker": id}
+    {"op": "sub", "room": r} / {"op": "unsub", "room": r}
+    {"op": "pub", "room": r, "event": {...}}
+    {"op": "send", "worker": id, "room": r, "event": {...}}
+    {"op": "all", "event": {...}}
+    {"op": "claim", "name": n} / {"op": "release", "name": n} / {"op": "heartbeat"}
+broker -> worker: the "pub", "send" and "all" lines of other workers, {"op": "gone", "worker": id},
+{"op": "members", "workers": [id, ...]}, {"op": "names", "add": {name: worker}, "remove":
+[name, ...]}, {"op": "denied", "name": n} and {"op": "expired"} (the worker's leases
+lapsed; it has to claim its names again). A "send" to a worker that is no longer
+connected goes back to its sender, which then handles the event itself.
+
+usage: python broker.py [socket path]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Optional
+
+# where the broker listens; server.py reads the same variable
+BACKPLANE_SOCKET = os.getenv("BACKPLANE_SOCKET", "/tmp/chat-backplane.sock")
+
+# longest accepted line (a full roster of a big room travels as one event)
+LINE_LIMIT = 16 * 1024 * 1024
+
+# seconds a worker's usernames stay reserved after its last heartbeat; server.py
+# heartbeats at a third of this
+LEASE_TTL = float(os.getenv("BACKPLANE_LEASE_TTL", "15"))
+
+
+class Broker:
+    """Room-keyed pub/sub between worker connections, plus the username registry."""
+
+    def __init__(self):
+        # room -> writers of the workers subscribed to it
+        self.subs: dict[str, set] = {}
+        # writer -> [worker id, subscribed rooms]
+        self.workers: dict = {}
+        # worker id -> writer
+        self.by_id: dict = {}
+        # normalized username -> worker id holding it
+        self.names: dict[str, str] = {}
+        # worker id -> names it holds, and when its lease runs out
+        self.held: dict[str, set] = {}
+        self.leases: dict[str, float] = {}
+
+    def _send(self, writer, line: bytes) -> None:
+        if not writer.is_closing():
+            writer.write(line)
+
+    def _announce_members(self) -> None:
+        line = (json.dumps({"op": "members", "workers": sorted(self.by_id)}) + "\n").encode()
+        for w in tuple(self.workers):
+            self._send(w, line)
+
+    def _announce_names(self, add: Optional[dict] = None, remove: list = (), skip=None) -> None:
+        line = (json.dumps({"op": "names", "add": add or {}, "remove": list(remove)}) + "\n").encode()
+        for w in tuple(self.workers):
+            if w is not skip:
+                self._send(w, line)
+
+    def claim(self, writer, worker: str, name: str) -> None:
+        holder = self.names.get(name)
+        if holder is not None and holder != worker:
+            self._send(writer, (json.dumps({"op": "denied", "name": name}) + "\n").encode())
+            return
+        self.leases[worker] = time.monotonic() + LEASE_TTL
+        if holder is None:
+            self.names[name] = worker
+            self.held.setdefault(worker, set()).add(name)
+            self._announce_names(add={name: worker}, skip=writer)
+
+    def release(self, worker: str, name: str) -> None:
+        if self.names.get(name) == worker:
+            del self.names[name]
+            self.held[worker].discard(name)
+            self._announce_names(remove=[name])
+
+    def release_all(self, worker: str) -> None:
+        names = self.held.pop(worker, ())
+        for name in names:
+            del self.names[name]
+        if names:
+            self._announce_names(remove=names)
+
+    async def expire_leases(self) -> None:
+        # a worker that stops heartbeating (hung, not disconnected) loses its names
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for worker, until in list(self.leases.items()):
+                if until < now:
+                    del self.leases[worker]
+                    self.release_all(worker)
+                    writer = self.by_id.get(worker)
+                    if writer is not None:
+                        self._send(writer, b'{"op": "expired"}\n')
+
+    def _unsubscribe(self, writer, room: str) -> None:
+        subs = self.subs.get(room)
+        if subs is not None:
+            subs.discard(writer)
+            if not subs:
+                del self.subs[room]
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        state = self.workers[writer] = [None, set()]
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    continue
+                op = msg.get("op")
+                if op == "pub":
+                    # forward the original bytes; only the room key is needed here
+                    for w in tuple(self.subs.get(msg.get("room"), ())):
+                        if w is not writer:
+                            self._send(w, line)
+                elif op == "send":
+                    self._send(self.by_id.get(msg.get("worker"), writer), line)
+                elif op == "all":
+                    for w in tuple(self.workers):
+                        if w is not writer:
+                            self._send(w, line)
+                elif op == "claim":
+                    self.claim(writer, state[0], msg["name"])
+                elif op == "release":
+                    self.release(state[0], msg["name"])
+                elif op == "heartbeat":
+                    self.leases[state[0]] = time.monotonic() + LEASE_TTL
+                elif op == "sub":
+                    self.subs.setdefault(msg["room"], set()).add(writer)
+                    state[1].add(msg["room"])
+                elif op == "unsub":
+                    self._unsubscribe(writer, msg["room"])
+                    state[1].discard(msg["room"])
+                elif op == "hello":
+                    state[0] = msg.get("worker")
+                    self.by_id[state[0]] = writer
+                    self.leases[state[0]] = time.monotonic() + LEASE_TTL
+                    self._announce_members()
+                    # the new worker starts from the full registry
+                    self._send(writer, (json.dumps({"op": "names", "add": self.names, "remove": []}) + "\n").encode())
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            worker, rooms = self.workers.pop(writer)
+            for room in rooms:
+                self._unsubscribe(writer, room)
+            if worker is not None and self.by_id.get(worker) is writer:
+                del self.by_id[worker]
+                self.leases.pop(worker, None)
+                self.release_all(worker)
+                gone = (json.dumps({"op": "gone", "worker": worker}) + "\n").encode()
+                for w in tuple(self.workers):
+                    self._send(w, gone)
+                self._announce_members()
+            writer.close()
+
+
+async def serve(path: str = BACKPLANE_SOCKET) -> None:
+    # a socket file left behind by a previous broker would make bind() fail
+    if os.path.exists(path):
+        os.unlink(path)
+    broker = Broker()
+    asyncio.ensure_future(broker.expire_leases())
+    server = await asyncio.start_unix_server(broker.handle, path=path, limit=LINE_LIMIT)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(sys.argv[1] if len(sys.argv) > 1 else BACKPLANE_SOCKET))
+    except KeyboardInterrupt:
+        pass
@@ -1,36 +1,437 @@
+import asyncio
+import base64
+import bisect
+import collections
+import functools
+import gzip
+import hashlib
+import hmac
+import itertools
 import json
+import logging
 import os
+import random
+import re
+import signal
 import sqlite3
+import threading
+import time
+import urllib.parse
 import webbrowser
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, status
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query, Request, status
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 
+try:
+    import orjson
+except ImportError:  # optional: faster JSON for the websocket hot path
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional: binary wire protocol for bots/high-volume clients
+    msgpack = None
+
 app = FastAPI()
 
+# upper bound (seconds) for delivering one frame to one connection during a fan-out
+SEND_TIMEOUT = float(os.getenv("SEND_TIMEOUT", "5"))
+
+# bound on frames waiting in a connection's outbound queue, and what to do when a
+# slow reader hits it: "drop_oldest", "drop_newest" or "disconnect"
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", "drop_oldest").strip().lower()
+if SLOW_CONSUMER_POLICY not in ("drop_oldest", "drop_newest", "disconnect"):
+    SLOW_CONSUMER_POLICY = "drop_oldest"
+
+# websocket JSON backend: "auto" (orjson when installed), "orjson" or "json"
+JSON_CODEC = os.getenv("JSON_CODEC", "auto").strip().lower()
+
+# joins/leaves in a room are merged over this window (seconds) into one announcement
+# and one roster delta; 0 flushes every change on the next loop iteration
+PRESENCE_WINDOW = float(os.getenv("PRESENCE_WINDOW", "0.25"))
+# names listed in a merged announcement before it switches to "and N others"
+PRESENCE_NAMES_MAX = 5
+
+
+class JsonCodec:
+    """Encodes/decodes websocket frames with the stdlib json module."""
+
+    name = "json"
+    binary = False
+
+    def encode(self, obj) -> str:
+        return json.dumps(obj)
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+
+class OrjsonCodec(JsonCodec):
+    """orjson-backed codec.
+
+    Output is compact UTF-8 rather than json.dumps' ASCII escapes, which parses to the
+    same values on the client. Anything orjson refuses but the stdlib accepts (lone
+    surrogates, integers over 64 bits) falls back to json. The one difference: NaN and
+    infinities encode as null, where json.dumps writes NaN/Infinity, which browsers'
+    JSON.parse rejects anyway. Decoding falls back the same way, so NaN input still parses.
+    """
+
+    name = "orjson"
+
+    def encode(self, obj) -> str:
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            return json.dumps(obj)
+
+    def decode(self, raw):
+        try:
+            return orjson.loads(raw)
+        except ValueError:
+            return json.loads(raw)
+
+
+def make_codec(name: str = JSON_CODEC) -> JsonCodec:
+    if name in ("auto", "orjson") and orjson is not None:
+        return OrjsonCodec()
+    return JsonCodec()
+
+
+class MsgpackCodec:
+    """MessagePack frames for clients that negotiate the "msgpack" subprotocol.
+
+    Carries exactly the payloads the JSON protocol does (chat, users, users_delta,
+    rainbow, open, ...), just packed into binary frames.
+    """
+
+    name = "msgpack"
+    binary = True
+
+    def encode(self, obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, raw):
+        return msgpack.unpackb(raw, raw=False)
+
+
+codec = make_codec()
+
+# binary codecs a client may pick via Sec-WebSocket-Protocol; JSON text stays the default
+SUBPROTOCOL_CODECS: dict = {}
+if msgpack is not None:
+    SUBPROTOCOL_CODECS["msgpack"] = MsgpackCodec()
+
+
+def negotiate_codec(ws: WebSocket) -> tuple:
+    # returns (subprotocol to accept or None, codec for this connection)
+    for proto in ws.scope.get("subprotocols") or ():
+        if proto in SUBPROTOCOL_CODECS:
+            return proto, SUBPROTOCOL_CODECS[proto]
+    return None, codec
+
+
+def normalize_name(name: Optional[str]) -> str:
+    return (name or "").strip().lower()
+
+
+class Connection:
+    """One live websocket plus its outbound queue and writer task."""
+
+    __slots__ = ("id", "ws", "room", "codec", "user", "is_admin", "queue", "writer", "closing", "session")
+
+    _ids = itertools.count(1)
+
+    def __init__(self, ws: WebSocket, room: str, wire_codec=None):
+        self.id = next(Connection._ids)
+        self.ws = ws
+        self.room = room
+        self.codec = wire_codec or codec
+        self.user: Optional[str] = None
+        self.is_admin = False
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.writer: Optional[asyncio.Task] = None
+        self.closing = False
+        # nonce of the resume session handed out at join
+        self.session: Optional[str] = None
+
+
+class Room:
+    """Active connections of one room, keyed by connection id.
+
+    Iteration goes through snapshot(), an immutable tuple that is rebuilt only
+    after the membership changed, so fan-outs do not copy the roster each time.
+    Joined connections are also indexed by normalized username for targeted lookups,
+    and every roster change bumps version so clients can apply presence deltas in order.
+    Users connected to other worker processes are tracked per worker in remote, from
+    the presence and roster events of the backplane.
+    """
+
+    __slots__ = ("name", "conns", "by_name", "remote", "version", "_snapshot",
+                 "pending_join", "pending_leave", "pending_anon", "flush_scheduled")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.conns: dict[int, Connection] = {}
+        self.by_name: dict[str, dict[int, Connection]] = {}
+        # worker id -> {normalized name: {"name", "is_admin"}}
+        self.remote: dict[str, dict[str, dict]] = {}
+        self.version = 0
+        self._snapshot: Optional[tuple] = ()
+        # presence changes not yet announced, keyed by normalized name:
+        # [Connection or display name, announce?]
+        self.pending_join: dict[str, list] = {}
+        self.pending_leave: dict[str, list] = {}
+        self.pending_anon = 0
+        self.flush_scheduled = False
+
+    def __len__(self) -> int:
+        return len(self.conns)
+
+    def __contains__(self, conn: Connection) -> bool:
+        return conn.id in self.conns
+
+    def add(self, conn: Connection) -> None:
+        self.conns[conn.id] = conn
+        self._snapshot = None
+
+    def remove(self, conn: Connection) -> bool:
+        # returns False if the connection was not (or no longer) in the room
+        if self.conns.pop(conn.id, None) is None:
+            return False
+        self._snapshot = None
+        key = normalize_name(conn.user)
+        named = self.by_name.get(key)
+        if named is not None:
+            named.pop(conn.id, None)
+            if not named:
+                del self.by_name[key]
+        return True
+
+    def index_user(self, conn: Connection) -> None:
+        # call once conn.user is set
+        if conn.id in self.conns:
+            self.by_name.setdefault(normalize_name(conn.user), {})[conn.id] = conn
+
+    def find(self, name: str) -> tuple:
+        named = self.by_name.get(normalize_name(name))
+        return tuple(named.values()) if named else ()
+
+    def local_users(self) -> list:
+        # one roster entry per username joined on this worker
+        users = []
+        for named in self.by_name.values():
+            for conn in named.values():
+                users.append({"name": (conn.user or "").strip(), "is_admin": bool(conn.is_admin)})
+                break
+        return users
+
+    def users(self) -> list:
+        # the whole room: local users plus those reported by other workers
+        users = self.local_users()
+        for remote in self.remote.values():
+            users.extend(u for key, u in remote.items() if key not in self.by_name)
+        return users
+
+    def has_user(self, name: str) -> bool:
+        key = normalize_name(name)
+        return key in self.by_name or any(key in remote for remote in self.remote.values())
+
+    def remote_count(self, name: str) -> int:
+        key = normalize_name(name)
+        return sum(1 for remote in self.remote.values() if key in remote)
+
+    def apply_remote(self, worker: str, add: list, remove: list) -> None:
+        remote = self.remote.setdefault(worker, {})
+        for name in remove:
+            remote.pop(normalize_name(name), None)
+        for u in add:
+            remote[normalize_name(u["name"])] = u
+        if not remote:
+            del self.remote[worker]
+
+    def set_remote(self, worker: str, users: list) -> tuple:
+        # replace a worker's whole roster; returns the (add, remove) lists that changed
+        old = self.remote.pop(worker, {})
+        new = {normalize_name(u["name"]): u for u in users}
+        if new:
+            self.remote[worker] = new
+        add = [u for key, u in new.items() if old.get(key) != u]
+        remove = [u["name"] for key, u in old.items() if key not in new]
+        return add, remove
+
+    def snapshot(self) -> tuple:
+        if self._snapshot is None:
+            self._snapshot = tuple(self.conns.values())
+        return self._snapshot
+
+
 # in-memory active websocket connections per room
-# each entry is a dict: {"ws": WebSocket, "user": str|None, "is_admin": bool}
-active_rooms: dict[str, list[dict]] = {}
+active_rooms: dict[str, Room] = {}
+
+# every joined connection across all rooms, keyed by normalized username
+users_by_name: dict[str, Connection] = {}
 
 # SQLite DB file for persistent rooms
 DB_PATH = os.path.join(os.path.dirname(__file__), "data.db")
 
+# sqlite calls from async handlers run on these threads so they never block the event loop
+DB_THREADS = int(os.getenv("DB_THREADS", "4"))
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="sqlite")
+
+# per-connection tuning; every thread keeps its own connection open (see get_db_connection)
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_CACHED_STATEMENTS = 256
+DB_BUSY_TIMEOUT_MS = 5000
+_db_local = threading.local()
+_db_conns: list = []
+_db_conns_lock = threading.Lock()
+
+# set by init_db(): whether the messages_fts search index exists
+fts_enabled = False
+
+# page size for GET /rooms when paginating (after/limit/prefix), and its upper bound
+ROOMS_PAGE_DEFAULT = 100
+ROOMS_PAGE_MAX = 1000
+
+# chat history is buffered in memory and committed in batches: a flush happens once
+# HISTORY_BATCH_SIZE messages are pending or HISTORY_FLUSH_INTERVAL seconds have passed
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "200"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))
+# while the DB keeps failing, flushes back off up to HISTORY_RETRY_MAX seconds and at most
+# HISTORY_PENDING_MAX messages are kept for them (the oldest are dropped first)
+HISTORY_RETRY_MAX = float(os.getenv("HISTORY_RETRY_MAX", "30"))
+HISTORY_PENDING_MAX = int(os.getenv("HISTORY_PENDING_MAX", "100000"))
+
+# page size for GET /rooms/{room}/messages, and its upper bound
+HISTORY_PAGE_DEFAULT = 50
+HISTORY_PAGE_MAX = 500
+
+# page size for GET /rooms/{room}/search, and its upper bound; ranked results are paged
+# by offset, which is capped so deep pages cannot turn into full scans
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 100
+SEARCH_MAX_OFFSET = 1000
+
+# history retention: global defaults for every room (0 = keep forever); rooms can override
+# them through PUT /rooms/{room}/retention. A background pass deletes expired rows in small
+# batches (one short write transaction each) and then returns freed pages to the OS.
+RETENTION_MAX_AGE_DAYS = float(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+RETENTION_MAX_ROWS = int(os.getenv("RETENTION_MAX_ROWS", "0"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "300"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "500"))
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.05"))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "2000"))
+# when set, expired messages are written to gzipped NDJSON segments here before deletion
+RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "")
+
+# recent messages kept in memory per room and replayed to joining clients, bounded both by
+# count and by approximate size so a room of huge messages cannot hog memory
+SCROLLBACK_SIZE = int(os.getenv("SCROLLBACK_SIZE", "50"))
+SCROLLBACK_MAX_BYTES = int(os.getenv("SCROLLBACK_MAX_BYTES", str(64 * 1024)))
+# with several workers, how long (seconds) a worker opening a room waits for the owner's
+# recent window (which covers messages not yet flushed to the DB)
+SCROLLBACK_BACKFILL_TIMEOUT = 1.0
+
+# how room events reach the other worker processes: "local" (single process) or "socket"
+# (broker.py over a Unix-domain socket; needed for uvicorn --workers N)
+BACKPLANE = os.getenv("BACKPLANE", "local").strip().lower()
+BACKPLANE_SOCKET = os.getenv("BACKPLANE_SOCKET", "/tmp/chat-backplane.sock")
+# backplane outages go to uvicorn's error log, next to the server's own messages
+log = logging.getLogger("uvicorn.error")
+# longest backplane line accepted (a full roster of a big room travels as one event)
+BACKPLANE_LINE_LIMIT = 16 * 1024 * 1024
+# points per worker on the consistent-hash ring that assigns each room an owner worker
+RING_VNODES = 64
+# usernames are leased from the broker for this long (seconds) past the last heartbeat
+BACKPLANE_LEASE_TTL = float(os.getenv("BACKPLANE_LEASE_TTL", "15"))
+
+# how often (seconds) the room catalog polls for rooms created by other processes
+CATALOG_REFRESH_INTERVAL = float(os.getenv("CATALOG_REFRESH_INTERVAL", "1"))
+
+# session resume: a join hands out a token (valid RESUME_TTL seconds) that lets a client
+# reconnecting after a blip or a deploy get back its name and just the messages it missed.
+# A token resumes its session once (the resumed session gets a new one) and stops working
+# when the user leaves or is kicked. RESUME_SECRET signs the tokens; when unset, a random
+# key kept in the DB is shared by all workers. Gaps longer than RESUME_REPLAY_MAX
+# messages fall back to a normal join
+RESUME_TTL = float(os.getenv("RESUME_TTL", "3600"))
+RESUME_SECRET = os.getenv("RESUME_SECRET", "")
+RESUME_REPLAY_MAX = int(os.getenv("RESUME_REPLAY_MAX", "500"))
+# how long (seconds) a resume waits for another worker to give up the session's username
+RESUME_TAKEOVER_TIMEOUT = 2.0
+# a session that drops (rather than closing) is taken off the roster right away, but its
+# "left the room" is held this many seconds and dropped if the user resumes meanwhile
+RESUME_GRACE = float(os.getenv("RESUME_GRACE", "5"))
+# seqs are reserved in the DB in blocks of SEQ_RESERVE_BLOCK before they are handed out,
+# so a restarted owner continues past unstored broadcasts (rainbow toggles, notices) too
+SEQ_RESERVE_BLOCK = 1000
+# with several workers, a room's new owner also starts this far past that, because the
+# previous owner may still be numbering messages relayed to it before the ring changed
+SEQ_HANDOFF_GAP = 1000
+
+# drain (SIGTERM, or POST /admin/drain for every worker; DELETE cancels it): clients are told to reconnect after a random
+# backoff in [DRAIN_BACKOFF_MIN, DRAIN_BACKOFF_MAX] seconds, then sockets are closed
+# DRAIN_BATCH at a time every DRAIN_BATCH_INTERVAL seconds; DRAIN_TIMEOUT bounds the
+# wait for their outbound queues to empty
+DRAIN_BACKOFF_MIN = float(os.getenv("DRAIN_BACKOFF_MIN", "1"))
+DRAIN_BACKOFF_MAX = float(os.getenv("DRAIN_BACKOFF_MAX", "10"))
+DRAIN_BATCH = int(os.getenv("DRAIN_BATCH", "100"))
+DRAIN_BATCH_INTERVAL = float(os.getenv("DRAIN_BATCH_INTERVAL", "0.1"))
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "10"))
+
 # Mount the static directory so /static/style.css can be served
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
-def get_db_connection():
-    # open a new connection per call; keep check_same_thread False for uvicorn threads
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+def _open_db_connection() -> sqlite3.Connection:
+    # check_same_thread stays False: a connection is only used by the thread that opened it,
+    # but it is closed from the main thread on shutdown
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
     return conn
 
 
+def get_db_connection() -> sqlite3.Connection:
+    # one long-lived connection per thread (event loop, DB pool workers, scripts),
+    # reopened if DB_PATH changed since it was created
+    cached = getattr(_db_local, "conn", None)
+    if cached is not None and cached[0] == DB_PATH:
+        return cached[1]
+    conn = _open_db_connection()
+    _db_local.conn = (DB_PATH, conn)
+    with _db_conns_lock:
+        _db_conns.append(conn)
+    return conn
+
+
+def close_db_connections() -> None:
+    with _db_conns_lock:
+        conns = list(_db_conns)
+        _db_conns.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
 def init_db() -> None:
     conn = get_db_connection()
-    try:
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # incremental auto-vacuum lets retention give pages back without a full VACUUM;
+        # switching an existing file needs one VACUUM, after that it is a no-op
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    # WAL is persistent in the file: readers no longer block behind the writer
+    conn.execute("PRAGMA journal_mode=WAL")
+    with conn:
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS rooms (
@@ -39,18 +440,205 @@ def init_db() -> None:
             )
             """
         )
-        conn.commit()
-    finally:
-        conn.close()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                room TEXT NOT NULL,
+                user TEXT NOT NULL,
+                text TEXT NOT NULL,
+                ts REAL NOT NULL,
+                seq INTEGER
+            )
+            """
+        )
+        if "seq" not in [row["name"] for row in conn.execute("PRAGMA table_info(messages)")]:
+            # per-room sequence number of the broadcast; NULL for history stored before it
+            conn.execute("ALTER TABLE messages ADD COLUMN seq INTEGER")
+        # keyset pagination of a room's history walks this index backwards
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, id)")
+        # resume replays a room's messages after a given seq
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_seq ON messages (room, seq)")
+        # per-room overrides of the global retention defaults; NULL inherits the default
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS room_retention (
+                room TEXT PRIMARY KEY,
+                max_age_days REAL,
+                max_rows INTEGER
+            )
+            """
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # per room, the highest seq its owner may have handed out (see SEQ_RESERVE_BLOCK)
+        conn.execute("CREATE TABLE IF NOT EXISTS seq_reservations (room TEXT PRIMARY KEY, reserved INTEGER NOT NULL)")
+        # resume sessions that were taken over or left; their tokens no longer resume
+        conn.execute("CREATE TABLE IF NOT EXISTS ended_sessions (nonce TEXT PRIMARY KEY, expires REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ended_sessions_expires ON ended_sessions (expires)")
+    init_fts(conn)
 
 
-def list_rooms() -> List[str]:
-    conn = get_db_connection()
+def init_fts(conn: sqlite3.Connection) -> None:
+    # full-text index over messages (external content: the text is stored only once);
+    # left disabled when this sqlite build has no FTS5
+    global fts_enabled
+    existed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
     try:
-        cur = conn.execute("SELECT name FROM rooms ORDER BY name")
-        return [row[0] for row in cur.fetchall()]
-    finally:
-        conn.close()
+        with conn:
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+                "USING fts5(text, room, content='messages', content_rowid='id')"
+            )
+            if not existed:
+                # index history stored before search existed
+                conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError:
+        fts_enabled = False
+        return
+    fts_enabled = True
+
+
+class RoomCatalog:
+    """In-process copy of the rooms table.
+
+    create_room() writes through to it, so room_exists() and list_rooms() are answered
+    from memory. Rooms created by other processes (start.sh, other workers) are picked
+    up by polling PRAGMA data_version on a dedicated connection: it changes whenever any
+    other connection commits, and costs no table read while nothing changed. Most of
+    those commits are messages, so a change is confirmed against MAX(id) of rooms (a
+    lookup on the rowid b-tree) before the names are read again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._path: Optional[str] = None
+        self._data_version = None
+        self._max_id = None
+        self._checked_at = 0.0
+        self._names: frozenset = frozenset()
+        self._sorted: tuple = ()
+        # bumped on every change to the set of rooms
+        self.version = 0
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._names
+
+    def refresh(self, force: bool = False) -> None:
+        # reload if another connection committed since the last check; without force,
+        # checks at most once per CATALOG_REFRESH_INTERVAL
+        if not force and self._conn is not None and time.monotonic() - self._checked_at < CATALOG_REFRESH_INTERVAL:
+            return
+        with self._lock:
+            if self._conn is None or self._path != DB_PATH:
+                if self._conn is not None:
+                    self._conn.close()
+                self._conn = _open_db_connection()
+                self._path = DB_PATH
+                self._data_version = None
+                self._max_id = None
+            self._checked_at = time.monotonic()
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+            # rooms are only ever inserted, so an unchanged MAX(id) means an unchanged table
+            max_id = self._conn.execute("SELECT MAX(id) FROM rooms").fetchone()[0]
+            if max_id == self._max_id:
+                return
+            names = tuple(row[0] for row in self._conn.execute("SELECT name FROM rooms ORDER BY name"))
+            self._max_id = max_id
+            if names != self._sorted:
+                self._sorted = names
+                self._names = frozenset(names)
+                self.version += 1
+
+    def add(self, name: str) -> None:
+        # write-through from create_room; a catalog that was never loaded picks it up on load
+        with self._lock:
+            if self._conn is None or name in self._names:
+                return
+            i = bisect.bisect_left(self._sorted, name)
+            self._sorted = self._sorted[:i] + (name,) + self._sorted[i:]
+            self._names = self._names | {name}
+            self.version += 1
+
+    def exists(self, name: str) -> bool:
+        if name in self._names:
+            return True
+        # rooms are never deleted, so only a miss needs to look for outside changes
+        self.refresh(force=True)
+        return name in self._names
+
+    def names(self) -> tuple:
+        self.refresh()
+        return self._sorted
+
+    def listing(self) -> tuple:
+        # (version, sorted names) read together, for caches keyed by version
+        self.refresh()
+        with self._lock:
+            return self.version, self._sorted
+
+    def page(self, after: str = "", prefix: str = "", limit: int = ROOMS_PAGE_DEFAULT) -> tuple:
+        """Keyset page of names > after that start with prefix: (names, next cursor or None).
+
+        Binary search over the sorted names, the in-memory counterpart of a range scan
+        on the UNIQUE index, so cost depends on the page size, not the number of rooms.
+        """
+        names = self.names()
+        lo = bisect.bisect_left(names, prefix) if prefix else 0
+        if after:
+            lo = max(lo, bisect.bisect_right(names, after))
+        out = []
+        for name in names[lo:lo + limit + 1]:
+            if prefix and not name.startswith(prefix):
+                break
+            out.append(name)
+        if len(out) > limit:
+            return out[:limit], out[limit - 1]
+        return out, None
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+room_catalog = RoomCatalog()
+
+
+def list_rooms() -> List[str]:
+    return list(room_catalog.names())
+
+
+# serialized GET /rooms body and its ETag, valid while the catalog version is unchanged
+_rooms_body_cache: tuple = (None, b"", "")
+
+
+def rooms_body() -> tuple:
+    """Return (body, etag) for the full room list, re-encoding only after a catalog change."""
+    global _rooms_body_cache
+    version, names = room_catalog.listing()
+    cached_version, body, etag = _rooms_body_cache
+    if cached_version != version:
+        # same encoding JSONResponse uses, so clients see identical bytes
+        body = json.dumps({"rooms": list(names)}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        # derived from the content so every worker hands out the same tag for the same list
+        etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        _rooms_body_cache = (version, body, etag)
+    return body, etag
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
 
 
 def create_room(name: str) -> bool:
@@ -59,30 +647,1372 @@ def create_room(name: str) -> bool:
     name = (name or "").strip().lower()
     conn = get_db_connection()
     try:
-        try:
+        # commits on success, rolls back so the shared connection is left clean on error
+        with conn:
             conn.execute("INSERT INTO rooms (name) VALUES (?)", (name,))
-            conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
-    finally:
-        conn.close()
+        room_catalog.add(name)
+        return True
+    except sqlite3.IntegrityError:
+        # may have been created by another process; make sure the catalog knows it
+        room_catalog.add(name)
+        return False
 
 
 def room_exists(name: str) -> bool:
     # normalize lookup
     name = (name or "").strip().lower()
+    return room_catalog.exists(name)
+
+
+def load_resume_key() -> bytes:
+    # RESUME_SECRET, or a random key created once and stored for every worker to share
+    if RESUME_SECRET:
+        return RESUME_SECRET.encode()
+    conn = get_db_connection()
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO settings (name, value) VALUES ('resume_secret', ?)", (os.urandom(32).hex(),)
+        )
+    return conn.execute("SELECT value FROM settings WHERE name = 'resume_secret'").fetchone()["value"].encode()
+
+
+def end_session(nonce: str) -> bool:
+    # mark a resume session ended; True only for the first caller, so a token resumes once
+    now = time.time()
+    conn = get_db_connection()
+    with conn:
+        # a row is only needed while a token naming the session could still be valid
+        conn.execute("DELETE FROM ended_sessions WHERE expires < ?", (now,))
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO ended_sessions (nonce, expires) VALUES (?, ?)", (nonce, now + RESUME_TTL)
+        )
+    return cur.rowcount == 1
+
+
+def max_seq(room: str) -> int:
+    # highest seq that may already be in use: stored, or reserved by an earlier owner
+    conn = get_db_connection()
+    stored = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM messages WHERE room = ?", (room,)).fetchone()[0]
+    row = conn.execute("SELECT reserved FROM seq_reservations WHERE room = ?", (room,)).fetchone()
+    return max(stored, row["reserved"] if row else 0)
+
+
+def reserve_seqs(room: str, upto: int) -> None:
+    conn = get_db_connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO seq_reservations (room, reserved) VALUES (?, ?) "
+            "ON CONFLICT (room) DO UPDATE SET reserved = MAX(reserved, excluded.reserved)",
+            (room, upto),
+        )
+
+
+def insert_messages(rows: list) -> None:
+    # rows of (room, user, text, ts, seq), committed as one transaction together with
+    # their search index entries
+    conn = get_db_connection()
+    with conn:
+        # take the write lock up front so the id range below is ours alone
+        conn.execute("BEGIN IMMEDIATE")
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        conn.executemany("INSERT INTO messages (room, user, text, ts, seq) VALUES (?, ?, ?, ?, ?)", rows)
+        if fts_enabled:
+            conn.execute(
+                "INSERT INTO messages_fts (rowid, text, room) SELECT id, text, room FROM messages WHERE id > ?",
+                (last_id,),
+            )
+
+
+_CONTROL_CHARS = re.compile(r"[\x00-\x1f\x7f]")
+
+
+def fts_match(room: str, q: str) -> str:
+    # quote every search word as a phrase so user input cannot inject FTS syntax;
+    # a trailing * keeps prefix search; control characters (NUL ends the query string
+    # inside FTS5) are dropped
+    terms = []
+    for word in q.split():
+        word = _CONTROL_CHARS.sub("", word)
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    if not terms:
+        return ""
+    expr = "text : (" + " ".join(terms) + ")"
+    if re.search(r"\w", room):
+        # narrow by room inside the index too; the exact room check happens in SQL
+        expr = 'room : "' + room.replace('"', '""') + '" AND ' + expr
+    return expr
+
+
+def search_messages(room: str, q: str, limit: int, offset: int) -> tuple:
+    """Best-ranked (bm25) messages in the room matching q, plus the next offset."""
+    match = fts_match(room, q)
+    if not match:
+        return [], None
+    conn = get_db_connection()
+    rows = conn.execute(
+        """
+        SELECT m.id, m.user, m.text, m.ts
+        FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+        WHERE messages_fts MATCH ? AND m.room = ?
+        ORDER BY bm25(messages_fts, 1.0, 0.0)
+        LIMIT ? OFFSET ?
+        """,
+        (match, room, limit + 1, offset),
+    ).fetchall()
+    next_offset = offset + limit if len(rows) > limit and offset + limit <= SEARCH_MAX_OFFSET else None
+    results = [{"id": row["id"], "user": row["user"], "text": row["text"], "ts": row["ts"]} for row in rows[:limit]]
+    return results, next_offset
+
+
+def fetch_messages(room: str, before: Optional[int], limit: int) -> tuple:
+    """Page of stored messages older than `before`, oldest first, plus the next cursor.
+
+    Uses the (room, id) index; cost depends on the page size, never on how deep the
+    client has scrolled.
+    """
+    conn = get_db_connection()
+    if before is None:
+        cur = conn.execute(
+            "SELECT id, user, text, ts, seq FROM messages WHERE room = ? ORDER BY id DESC LIMIT ?",
+            (room, limit + 1),
+        )
+    else:
+        cur = conn.execute(
+            "SELECT id, user, text, ts, seq FROM messages WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (room, before, limit + 1),
+        )
+    rows = cur.fetchall()
+    next_cursor = rows[limit - 1]["id"] if len(rows) > limit else None
+    messages = [
+        {"id": row["id"], "user": row["user"], "text": row["text"], "ts": row["ts"], "seq": row["seq"]}
+        for row in rows[:limit]
+    ]
+    messages.reverse()
+    return messages, next_cursor
+
+
+def fetch_messages_since(room: str, after_seq: int, limit: int) -> list:
+    # stored messages with seq > after_seq, oldest first, via the (room, seq) index
+    conn = get_db_connection()
+    rows = conn.execute(
+        "SELECT user, text, seq FROM messages WHERE room = ? AND seq > ? ORDER BY seq LIMIT ?",
+        (room, after_seq, limit),
+    ).fetchall()
+    return [{"user": row["user"], "text": row["text"], "seq": row["seq"]} for row in rows]
+
+
+def retention_overrides() -> dict:
+    conn = get_db_connection()
+    rows = conn.execute("SELECT room, max_age_days, max_rows FROM room_retention").fetchall()
+    return {row["room"]: (row["max_age_days"], row["max_rows"]) for row in rows}
+
+
+def set_retention(room: str, max_age_days: Optional[float], max_rows: Optional[int]) -> None:
     conn = get_db_connection()
+    with conn:
+        if max_age_days is None and max_rows is None:
+            conn.execute("DELETE FROM room_retention WHERE room = ?", (room,))
+        else:
+            conn.execute(
+                "INSERT OR REPLACE INTO room_retention (room, max_age_days, max_rows) VALUES (?, ?, ?)",
+                (room, max_age_days, max_rows),
+            )
+
+
+def archive_messages(rows: list) -> None:
+    # one gzipped NDJSON segment per pruned batch: <dir>/<room>/<first id>-<last id>.ndjson.gz,
+    # written to a temp name and renamed so a crash never leaves a partial segment
+    room = rows[0]["room"]
+    room_dir = os.path.join(RETENTION_ARCHIVE_DIR, urllib.parse.quote(room, safe=""))
+    os.makedirs(room_dir, exist_ok=True)
+    path = os.path.join(room_dir, f"{rows[0]['id']:012d}-{rows[-1]['id']:012d}.ndjson.gz")
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps({"id": row["id"], "room": row["room"], "user": row["user"], "text": row["text"], "ts": row["ts"], "seq": row["seq"]}) + "\n")
+    os.replace(tmp, path)
+
+
+def retention_keep_after(room: str, max_rows: int) -> int:
+    # ids up to this one fall outside the newest max_rows (0: none do). Computed once per
+    # pass: newer messages only push it up, so it stays safe to delete below
+    conn = get_db_connection()
+    row = conn.execute(
+        "SELECT id FROM messages WHERE room = ? ORDER BY id DESC LIMIT 1 OFFSET ?", (room, max_rows - 1)
+    ).fetchone()
+    return row["id"] - 1 if row else 0
+
+
+def prune_batch(room: str, keep_after: int, cutoff_ts: Optional[float]) -> int:
+    """Delete up to RETENTION_BATCH of the room's oldest expired messages; returns the count.
+
+    Reads only the oldest RETENTION_BATCH rows through the (room, id) index and deletes the
+    leading run that is expired, so a pass never scans a room's live history. Finding and
+    archiving that run happen before the write lock is taken, and a room with nothing
+    expired never takes it.
+    """
+    conn = get_db_connection()
+    rows = conn.execute(
+        "SELECT id, room, user, text, ts, seq FROM messages WHERE room = ? ORDER BY id LIMIT ?", (room, RETENTION_BATCH)
+    ).fetchall()
+    expired = []
+    for row in rows:
+        if row["id"] <= keep_after or (cutoff_ts is not None and row["ts"] < cutoff_ts):
+            expired.append(row)
+        else:
+            break
+    if not expired:
+        return 0
+    if RETENTION_ARCHIVE_DIR:
+        archive_messages(expired)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if fts_enabled:
+            # external-content FTS needs the old values to drop its entries; read inside
+            # the transaction so only rows that still exist are removed from the index
+            conn.execute(
+                "INSERT INTO messages_fts (messages_fts, rowid, text, room) "
+                "SELECT 'delete', id, text, room FROM messages WHERE room = ? AND id <= ?",
+                (room, expired[-1]["id"]),
+            )
+        conn.execute("DELETE FROM messages WHERE room = ? AND id <= ?", (room, expired[-1]["id"]))
+    return len(expired)
+
+
+def incremental_vacuum() -> None:
+    get_db_connection().execute(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES})").fetchall()
+
+
+async def run_retention() -> int:
+    # one pass over every room with a policy; yields between batches so writers get the lock
+    overrides = await run_db(retention_overrides)
+    deleted = 0
+    for room in await run_db(room_catalog.names):
+        if backplane.owner(room) != backplane.worker_id:
+            # every room is pruned by its owner worker only
+            continue
+        max_age_days, max_rows = overrides.get(room, (None, None))
+        if max_age_days is None:
+            max_age_days = RETENTION_MAX_AGE_DAYS
+        if max_rows is None:
+            max_rows = RETENTION_MAX_ROWS
+        if not max_age_days and not max_rows:
+            continue
+        keep_after = await run_db(retention_keep_after, room, max_rows) if max_rows else 0
+        cutoff_ts = time.time() - max_age_days * 86400 if max_age_days else None
+        while True:
+            n = await run_db(prune_batch, room, keep_after, cutoff_ts)
+            deleted += n
+            if n < RETENTION_BATCH:
+                break
+            await asyncio.sleep(RETENTION_BATCH_PAUSE)
+    if deleted:
+        await run_db(incremental_vacuum)
+    return deleted
+
+
+async def retention_loop() -> None:
+    while True:
+        await asyncio.sleep(RETENTION_INTERVAL)
+        try:
+            await run_retention()
+        except Exception:
+            # a failed pass (e.g. archive dir not writable) keeps its rows; try again later
+            log.exception("retention pass failed; retrying in %.0fs", RETENTION_INTERVAL)
+
+
+class MessageWriter:
+    """Write-behind buffer for chat history.
+
+    add() only appends to a list, so storing a message costs the broadcast path nothing;
+    batches are committed on the DB pool by a single flusher, which keeps one transaction
+    (and one fsync) per batch instead of per message. A failed batch is put back and
+    retried with backoff, and close() drains everything before shutdown.
+    """
+
+    def __init__(self):
+        self._pending: list = []
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        # seconds until the next retry while flushes fail; 0 when the last one succeeded
+        self._retry_delay = 0.0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, room: str, user: str, text: str, ts: float, seq: Optional[int] = None) -> None:
+        self._pending.append((room, user, text, ts, seq))
+        if self._retry_delay:
+            # the DB is failing: wait for the retry timer, within the buffer cap
+            self._trim()
+        elif len(self._pending) >= HISTORY_BATCH_SIZE:
+            asyncio.ensure_future(self.flush())
+        elif self._timer is None or self._timer.done():
+            self._timer = asyncio.ensure_future(self._flush_later(HISTORY_FLUSH_INTERVAL))
+
+    def _trim(self) -> None:
+        excess = len(self._pending) - HISTORY_PENDING_MAX
+        if excess > 0:
+            del self._pending[:excess]
+            log.error("history buffer full: dropped %d unstored messages", excess)
+
+    async def _flush_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self) -> None:
+        # one flusher at a time keeps batches in order
+        async with self._lock:
+            while self._pending:
+                batch, self._pending = self._pending, []
+                try:
+                    await run_db(insert_messages, batch)
+                except Exception as exc:
+                    # keep the batch (ahead of anything newer) and retry later
+                    self._pending = batch + self._pending
+                    self._trim()
+                    self._retry_delay = min(max(self._retry_delay * 2, HISTORY_FLUSH_INTERVAL), HISTORY_RETRY_MAX)
+                    log.warning(
+                        "storing %d messages failed (%s); retrying in %.1fs", len(batch), exc, self._retry_delay
+                    )
+                    # (a flush run by the timer itself still counts as having none)
+                    if self._timer is None or self._timer.done() or self._timer is asyncio.current_task():
+                        self._timer = asyncio.ensure_future(self._flush_later(self._retry_delay))
+                    return
+                self._retry_delay = 0.0
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        await self.flush()
+        if self._pending:
+            self._timer.cancel()
+            log.error("shutting down with %d messages that could not be stored", len(self._pending))
+
+
+message_writer = MessageWriter()
+
+# background retention pass, started with the app
+retention_task: Optional[asyncio.Task] = None
+
+# set once a drain starts; new websocket connections are refused from then on
+draining = False
+
+
+class Scrollback:
+    """Ring buffer of a room's most recent broadcasts.
+
+    Entries are (payload, stored) pairs. Joining clients get the stored chat; payloads
+    carry their seq, so the whole buffer, control frames and notices included, is also
+    the window that resuming clients are replayed from.
+
+    The encoded history frame is cached per wire codec until the next message, so a burst
+    of joins encodes it once.
+    """
+
+    __slots__ = ("messages", "size", "complete", "_frames")
+
+    def __init__(self):
+        self.messages: collections.deque = collections.deque()
+        self.size = 0
+        # False when it was rebuilt without the owner's window and may miss recent entries
+        self.complete = True
+        self._frames: dict = {}
+
+    @staticmethod
+    def _cost(payload: dict) -> int:
+        # rough per-entry footprint; exact accounting is not worth it
+        return len(payload.get("user") or "") + len(payload.get("text") or "") + 64
+
+    def append(self, payload: dict, stored: bool = True) -> None:
+        self.messages.append((payload, stored))
+        self.size += self._cost(payload)
+        while self.messages and (len(self.messages) > SCROLLBACK_SIZE or self.size > SCROLLBACK_MAX_BYTES):
+            self.size -= self._cost(self.messages.popleft()[0])
+        self._frames.clear()
+
+    def merge(self, entries) -> None:
+        # fold in (payload, stored) entries from elsewhere (stored history, the owner's
+        # window) by seq; entries already present are skipped
+        known = {payload.get("seq") for payload, _ in self.messages}
+        combined = list(self.messages)
+        for payload, stored in entries:
+            if payload.get("seq") not in known:
+                known.add(payload.get("seq"))
+                combined.append((payload, stored))
+        combined.sort(key=lambda e: e[0].get("seq") or 0)
+        self.messages.clear()
+        self.size = 0
+        for payload, stored in combined:
+            self.append(payload, stored)
+        self._frames.clear()
+
+    def payloads(self) -> list:
+        return [payload for payload, _ in self.messages]
+
+    def frame(self, wire_codec):
+        frame = self._frames.get(wire_codec)
+        if frame is None:
+            chat = [payload for payload, stored in self.messages if stored]
+            frame = self._frames[wire_codec] = wire_codec.encode({"type": "history", "messages": chat})
+        return frame
+
+
+# per-room scrollback; outlives the room's active connections
+scrollbacks: dict[str, Scrollback] = {}
+# room -> future resolved once the owner's window arrived, while a worker opens the room
+backfills: dict[str, asyncio.Future] = {}
+
+
+def hears_room(room: str) -> bool:
+    # whether every broadcast of the room reaches this worker: it has connections there,
+    # owns (and so numbers) the room, or is the only process
+    return room in active_rooms or not backplane.shared or backplane.owner(room) == backplane.worker_id
+
+
+def remember_message(room: str, payload: dict, stored: bool = True) -> None:
+    if SCROLLBACK_SIZE <= 0:
+        return
+    sb = scrollbacks.get(room)
+    if sb is None:
+        sb = scrollbacks[room] = Scrollback()
+    sb.append(payload, stored)
+
+
+def send_history(entry: Connection) -> None:
+    # one batched frame with the room's recent messages; never touches the DB
+    sb = scrollbacks.get(entry.room)
+    if sb is not None and sb.messages:
+        enqueue_frame(entry, sb.frame(entry.codec))
+
+
+# room -> [last seq handed out, reserved up to], for rooms this worker has owned without
+# interruption; only the room's owner numbers its broadcasts
+room_seqs: dict[str, list] = {}
+# highest seq this worker has seen broadcast per room
+seen_seqs: dict[str, int] = {}
+
+# HMAC key for resume tokens, loaded at startup
+resume_key = b""
+
+
+def note_seq(room: str, seq: Optional[int]) -> None:
+    if seq and seq > seen_seqs.get(room, 0):
+        seen_seqs[room] = seq
+
+
+async def next_seq(room: str) -> int:
+    # counters are dropped when the room may have had another owner (see handle_event),
+    # so a missing one restarts past everything stored, reserved or seen
+    while True:
+        counter = room_seqs.get(room)
+        if counter is not None and counter[0] < counter[1]:
+            counter[0] += 1
+            return counter[0]
+        if counter is None:
+            top = await run_db(max_seq, room)
+            if room in room_seqs:
+                continue
+            # a single process (re)starting after itself has no one else's numbers in flight
+            start = max(top, seen_seqs.get(room, 0)) + (SEQ_HANDOFF_GAP if backplane.shared else 0)
+            counter = room_seqs[room] = [start, start]
+        # the block is on disk before any number in it goes out
+        upto = counter[0] + SEQ_RESERVE_BLOCK
+        await run_db(reserve_seqs, room, upto)
+        counter[1] = max(counter[1], upto)
+
+
+def make_resume_token(room: str, user: str, nonce: str) -> str:
+    claims = json.dumps({"r": room, "u": user, "n": nonce, "exp": int(time.time() + RESUME_TTL)})
+    body = base64.urlsafe_b64encode(claims.encode()).decode().rstrip("=")
+    sig = hmac.new(resume_key, body.encode(), hashlib.sha256).hexdigest()
+    return f"{body}.{sig}"
+
+
+_RESUME_TOKEN = re.compile(r"[A-Za-z0-9_-]+\.[0-9a-f]{64}")
+
+
+def check_resume_token(token, room: str, user: str) -> Optional[str]:
+    # the session nonce of a token that is ours, unexpired, and issued for this room and
+    # username; the shape is checked first, so anything past it is plain ASCII
+    if not isinstance(token, str) or not _RESUME_TOKEN.fullmatch(token):
+        return None
+    body, sig = token.encode().split(b".")
+    if not hmac.compare_digest(sig, hmac.new(resume_key, body, hashlib.sha256).hexdigest().encode()):
+        return None
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(body + b"=" * (-len(body) % 4)))
+    except ValueError:
+        return None
+    if (
+        claims.get("r") == room
+        and normalize_name(claims.get("u")) == normalize_name(user)
+        and claims.get("exp", 0) > time.time()
+    ):
+        return claims.get("n")
+    return None
+
+
+def forget_session(entry: Connection) -> None:
+    # the user left for good (or was kicked): the session's token must not bring it back
+    if entry.session:
+        asyncio.ensure_future(run_db(end_session, entry.session))
+        entry.session = None
+
+
+async def replay_since(entry: Connection, last_seq: int) -> bool:
+    """Send a resuming client what it missed after last_seq, as one history frame.
+
+    The scrollback answers when it is complete and still reaches back to last_seq; other
+    gaps are read from stored history (broadcasts that are not stored, like admin notices, are not
+    replayed from there). Returns False when the gap is too long to replay.
+    """
+    sb = scrollbacks.get(entry.room)
+    window = sb.payloads() if sb is not None else []
+    if window and sb.complete and (window[0].get("seq") or 0) <= last_seq + 1:
+        missed = [m for m in window if (m.get("seq") or 0) > last_seq]
+    else:
+        missed = await run_db(fetch_messages_since, entry.room, last_seq, RESUME_REPLAY_MAX + 1)
+        if len(missed) > RESUME_REPLAY_MAX:
+            return False
+        top = missed[-1]["seq"] if missed else last_seq
+        missed.extend(m for m in window if (m.get("seq") or 0) > top)
+    if missed:
+        send_to(entry, {"type": "history", "messages": missed})
+    return True
+
+
+async def fill_scrollback(room: str) -> None:
+    """Rebuild the scrollback of a room this worker starts hearing (several workers only).
+
+    Called right after subscribing, so live events already collect in it; stored history
+    and the owner's recent window, which also holds what the owner has not flushed to the
+    DB yet, are merged in by seq. Without the owner's answer the scrollback is marked
+    incomplete and resumes fall back to stored history.
+    """
+    if SCROLLBACK_SIZE <= 0:
+        return
+    sb = scrollbacks.get(room)
+    if sb is None:
+        sb = scrollbacks[room] = Scrollback()
+    waiter = None
+    if backplane.owner(room) != backplane.worker_id:
+        waiter = backfills[room] = asyncio.get_running_loop().create_future()
+        await backplane.send(backplane.owner(room), room, {"op": "backfill"})
+    messages, _ = await run_db(fetch_messages, room, None, SCROLLBACK_SIZE)
+    sb.merge(({"user": m["user"], "text": m["text"], "seq": m["seq"]}, True) for m in messages)
+    for m in messages:
+        note_seq(room, m["seq"])
+    if waiter is not None:
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), SCROLLBACK_BACKFILL_TIMEOUT)
+        except asyncio.TimeoutError:
+            sb.complete = False
+        finally:
+            if backfills.get(room) is waiter:
+                del backfills[room]
+
+
+class HashRing:
+    """Consistent-hash ring of worker ids.
+
+    Each worker sits at RING_VNODES points, so adding or removing one moves only about
+    1/N of the rooms to a different owner.
+    """
+
+    __slots__ = ("workers", "_points", "_owners")
+
+    def __init__(self, workers=(), vnodes: int = RING_VNODES):
+        self.workers = tuple(sorted(workers))
+        points = sorted((self._hash(f"{w}#{i}"), w) for w in self.workers for i in range(vnodes))
+        self._points = [p for p, _ in points]
+        self._owners = [w for _, w in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big")
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[i]
+
+
+class LocalBackplane:
+    """Room event bus of a single process: published events go straight to the handler.
+
+    Everything that must reach a whole room (chat, presence, admin actions) is published
+    as an event; handle_event() then applies it to this worker's own connections. Each
+    room also has an owner worker that persists and fans out its chat; here that is
+    always this process.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self.worker_id = str(os.getpid())
+        self.handler = None
+        self.ring = HashRing([self.worker_id])
+
+    def owner(self, room: str) -> str:
+        return self.ring.owner(room) or self.worker_id
+
+    async def start(self, handler) -> None:
+        self.handler = handler
+
+    def subscribe(self, room: str) -> None:
+        pass
+
+    def unsubscribe(self, room: str) -> None:
+        pass
+
+    async def publish(self, room: str, event: dict) -> None:
+        event["worker"] = self.worker_id
+        await self.handler(room, event)
+
+    async def send(self, worker: str, room: str, event: dict) -> None:
+        # deliver an event to one worker only (normally the room's owner)
+        event["worker"] = self.worker_id
+        await self.handler(room, event)
+
+    async def publish_all(self, event: dict) -> None:
+        # deliver an event that is not about one room to every worker, this one included
+        event["worker"] = self.worker_id
+        await self.handler(None, event)
+
+    def name_taken(self, key: str) -> bool:
+        # held by a user on another worker, as far as this worker knows
+        return False
+
+    def name_holder(self, key: str) -> Optional[str]:
+        # the other worker holding a username, if any
+        return None
+
+    async def wait_released(self, key: str, timeout: float) -> bool:
+        # until no other worker holds the username; False if it is still held at timeout
+        return True
+
+    def reserve(self, key: str) -> None:
+        # claim a normalized username cluster-wide; a denial comes back as a "denied" event
+        pass
+
+    def release(self, key: str) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class SocketBackplane(LocalBackplane):
+    """Shares room events between worker processes through broker.py.
+
+    Events are handled locally right away and sent to the broker, which relays them to
+    the other workers subscribed to the room. The broker also announces the live workers,
+    from which every worker builds the same ownership ring. While the broker is
+    unreachable the worker owns every room itself, keeps serving its own clients and
+    reconnects in the background.
+
+    Usernames are reserved in the broker's registry. Every grant is pushed to all
+    workers, so names held elsewhere are refused from the local copy in names, and a
+    free name is used right away: the claim costs one message, and only the rare loser
+    of a simultaneous claim hears back.
+    """
+
+    shared = True
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.rooms: set = set()
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+        # normalized username -> worker holding it, for names held by other workers
+        self.names: dict[str, str] = {}
+        # normalized username -> event set when it is released, for wait_released()
+        self.released: dict[str, asyncio.Event] = {}
+
+    async def start(self, handler) -> None:
+        await super().start(handler)
+        self.task = asyncio.ensure_future(self._run())
+
+    def _send(self, msg: dict) -> None:
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(codec.encode(msg).encode() + b"\n")
+
+    def subscribe(self, room: str) -> None:
+        self.rooms.add(room)
+        self._send({"op": "sub", "room": room})
+
+    def unsubscribe(self, room: str) -> None:
+        self.rooms.discard(room)
+        self._send({"op": "unsub", "room": room})
+
+    async def publish(self, room: str, event: dict) -> None:
+        event["worker"] = self.worker_id
+        self._send({"op": "pub", "room": room, "event": event})
+        await self.handler(room, event)
+
+    async def send(self, worker: str, room: str, event: dict) -> None:
+        if worker == self.worker_id or self.writer is None:
+            await super().send(worker, room, event)
+            return
+        event["worker"] = self.worker_id
+        # an owner that is already gone bounces it back here, and we handle it ourselves
+        self._send({"op": "send", "worker": worker, "room": room, "event": event})
+
+    async def publish_all(self, event: dict) -> None:
+        event["worker"] = self.worker_id
+        self._send({"op": "all", "event": event})
+        await self.handler(None, event)
+
+    def name_taken(self, key: str) -> bool:
+        return key in self.names
+
+    def name_holder(self, key: str) -> Optional[str]:
+        return self.names.get(key)
+
+    async def wait_released(self, key: str, timeout: float) -> bool:
+        if key not in self.names:
+            return True
+        event = self.released.setdefault(key, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def reserve(self, key: str) -> None:
+        self._send({"op": "claim", "name": key})
+
+    def release(self, key: str) -> None:
+        self._send({"op": "release", "name": key})
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(BACKPLANE_LEASE_TTL / 3)
+            self._send({"op": "heartbeat"})
+
+    async def _dispatch(self, room: Optional[str], event: dict) -> None:
+        try:
+            await self.handler(room, event)
+        except Exception:
+            # one bad event must not stop the stream
+            pass
+
+    async def _run(self) -> None:
+        delay = 0.1
+        alone = False
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path, limit=BACKPLANE_LINE_LIMIT)
+            except OSError as exc:
+                if not alone and delay >= 1:
+                    # once per outage, and not for the moment at boot before the broker listens
+                    log.warning("backplane broker at %s unreachable (%s); worker %s runs alone until it is back", self.path, exc, self.worker_id)
+                    alone = True
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+            if alone:
+                log.info("backplane broker at %s reachable again; worker %s rejoined", self.path, self.worker_id)
+                alone = False
+            delay = 0.1
+            # the broker sends the full name registry right after hello
+            self.names = {}
+            self._send({"op": "hello", "worker": self.worker_id})
+            for room in self.rooms:
+                self._send({"op": "sub", "room": room})
+            # the other workers dropped our users (and the broker our names) if they saw
+            # us go; re-announce and re-claim them
+            await self._dispatch(None, {"op": "reconnected"})
+            heartbeat = asyncio.ensure_future(self._heartbeat())
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    try:
+                        msg = codec.decode(line)
+                    except ValueError:
+                        continue
+                    op = msg.get("op")
+                    if op in ("pub", "send", "all"):
+                        # "all" events carry no room and arrive with room None
+                        await self._dispatch(msg.get("room"), msg.get("event") or {})
+                    elif op == "members":
+                        # resent whenever any worker comes or goes; only a changed list
+                        # moves rooms
+                        workers = tuple(sorted(msg.get("workers") or ()))
+                        if workers != self.ring.workers:
+                            self.ring = HashRing(workers)
+                            await self._dispatch(None, {"op": "members"})
+                    elif op == "names":
+                        for key in msg.get("remove") or ():
+                            self.names.pop(key, None)
+                            event = self.released.pop(key, None)
+                            if event is not None:
+                                event.set()
+                        for key, worker in (msg.get("add") or {}).items():
+                            if worker != self.worker_id:
+                                self.names[key] = worker
+                    elif op == "denied":
+                        await self._dispatch(None, msg)
+                    elif op == "expired":
+                        # our leases lapsed (e.g. the loop stalled): claim the names again
+                        await self._dispatch(None, {"op": "reconnected"})
+                    elif op == "gone":
+                        await self._dispatch(None, msg)
+            except (OSError, ValueError):
+                pass
+            finally:
+                heartbeat.cancel()
+                self.writer.close()
+                self.writer = None
+                # alone until the broker is back
+                self.ring = HashRing([self.worker_id])
+            await asyncio.sleep(delay)
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def make_backplane(name: str = BACKPLANE) -> LocalBackplane:
+    if name == "socket":
+        return SocketBackplane(BACKPLANE_SOCKET)
+    return LocalBackplane()
+
+
+backplane = make_backplane()
+
+
+async def _close_quietly(ws: WebSocket) -> None:
+    try:
+        await asyncio.wait_for(ws.close(), SEND_TIMEOUT)
+    except Exception:
+        pass
+
+
+async def _writer(entry: Connection) -> None:
+    # drain the connection's outbound queue onto the socket; a None frame means close
+    ws = entry.ws
+    queue = entry.queue
     try:
-        cur = conn.execute("SELECT 1 FROM rooms WHERE name = ? LIMIT 1", (name,))
-        return cur.fetchone() is not None
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                break
+            if isinstance(frame, bytes):
+                await asyncio.wait_for(ws.send_bytes(frame), SEND_TIMEOUT)
+            else:
+                await asyncio.wait_for(ws.send_text(frame), SEND_TIMEOUT)
+    except Exception:
+        # send failed or timed out: the client is gone or too slow to keep
+        evict(entry)
     finally:
-        conn.close()
+        # closing lets the connection's own handler run the usual leave cleanup
+        await _close_quietly(ws)
+
+
+def open_connection(ws: WebSocket, room: str, wire_codec=None) -> Connection:
+    entry = Connection(ws, room, wire_codec)
+    entry.writer = asyncio.ensure_future(_writer(entry))
+    return entry
+
+
+def enqueue_frame(entry: Connection, frame) -> None:
+    # never blocks the caller; overflow is resolved by SLOW_CONSUMER_POLICY
+    queue = entry.queue
+    if entry.closing:
+        return
+    if queue.qsize() >= OUTBOUND_QUEUE_SIZE:
+        if SLOW_CONSUMER_POLICY == "drop_newest":
+            return
+        if SLOW_CONSUMER_POLICY == "disconnect":
+            evict(entry)
+            entry.writer.cancel()
+            return
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+    queue.put_nowait(frame)
+
+
+def send_to(entry: Connection, payload: dict) -> None:
+    enqueue_frame(entry, entry.codec.encode(payload))
+
+
+def close_connection(entry: Connection) -> None:
+    # close after everything already queued for this connection has been sent
+    if not entry.closing:
+        entry.closing = True
+        entry.queue.put_nowait(None)
+
+
+def room_snapshot(room: str) -> tuple:
+    r = active_rooms.get(room)
+    return r.snapshot() if r else ()
+
+
+def find_in_room(room: str, name: str) -> tuple:
+    # connections in the room joined under the given name (case-insensitive)
+    r = active_rooms.get(room)
+    return r.find(name) if r else ()
+
+
+def claim_username(entry: Connection, username: str) -> bool:
+    # register the username globally (case-insensitive); False if someone else holds it,
+    # here or (as far as the backplane registry tells us) on another worker
+    key = normalize_name(username)
+    holder = users_by_name.get(key)
+    if holder is not None and holder is not entry:
+        return False
+    if backplane.name_taken(key):
+        return False
+    if holder is None:
+        backplane.reserve(key)
+    users_by_name[key] = entry
+    entry.user = username
+    r = active_rooms.get(entry.room)
+    if r is not None:
+        r.index_user(entry)
+    return True
+
+
+def leave_room(room: str, entry: Connection) -> bool:
+    # drop the connection from the room, and the room itself once it is empty
+    r = active_rooms.get(room)
+    if r is None or not r.remove(entry):
+        return False
+    if not r:
+        del active_rooms[room]
+        if backplane.shared:
+            backplane.unsubscribe(room)
+            if not hears_room(room):
+                # this worker stops hearing the room, so its scrollback would go stale
+                scrollbacks.pop(room, None)
+            if r.pending_leave or r.pending_anon:
+                # leaves queued here still have to reach the other workers
+                asyncio.ensure_future(flush_presence(r))
+    key = normalize_name(entry.user)
+    if key and users_by_name.get(key) is entry:
+        del users_by_name[key]
+        backplane.release(key)
+    return True
+
+
+def reject_username(entry: Connection) -> None:
+    # another worker won the race for this connection's name; the join announcement
+    # is normally still pending, so leaving now cancels it
+    send_to(entry, {"user": "system", "text": f"Username '{entry.user}' is already in use"})
+    if leave_room(entry.room, entry):
+        note_leave(entry.room, entry.user, announce=False)
+    close_connection(entry)
+
+
+def note_join(entry: Connection, announce: bool = True) -> None:
+    # queue a join for the room's next presence flush
+    r = active_rooms.get(entry.room)
+    if r is None:
+        return
+    key = normalize_name(entry.user)
+    left = r.pending_leave.pop(key, None)
+    if left is not None and left[1]:
+        # left and came back within one window (reconnect): announce neither
+        announce = False
+    r.pending_join[key] = [entry, announce]
+    _schedule_presence_flush(r)
+
+
+def note_leave(room: str, name: Optional[str], announce: bool = True) -> None:
+    # queue a leave for the room's next presence flush; called after leave_room()
+    if draining:
+        # these users are only moving to another instance
+        announce = False
+    r = active_rooms.get(room)
+    if r is None:
+        # room is empty on this worker now; other workers may still have people in it
+        if backplane.shared and (name or announce):
+            text = f"{name or 'A user'} left the room" if announce else ""
+            event = {"op": "presence", "text": text, "add": [], "remove": [name] if name else []}
+            asyncio.ensure_future(backplane.publish(room, event))
+        return
+    if not name:
+        if announce:
+            r.pending_anon += 1
+            _schedule_presence_flush(r)
+        return
+    if r.find(name):
+        # still connected under that name
+        return
+    key = normalize_name(name)
+    joined = r.pending_join.pop(key, None)
+    if joined is not None and joined[1]:
+        # joined and left within one window: nobody saw the join, skip both
+        # announcements but still send the removal in case a snapshot included it
+        announce = False
+    r.pending_leave[key] = [name, announce]
+    _schedule_presence_flush(r)
+
+
+def announce_dropped(room: str, name: str) -> None:
+    # the resume grace of a dropped session ran out: announce the leave, unless the name
+    # is back (resumed or joined again) here or on another worker
+    key = normalize_name(name)
+    if key in users_by_name or backplane.name_taken(key):
+        return
+    # text only: the roster removal went out when the connection dropped
+    event = {"op": "presence", "text": f"{name} left the room", "add": [], "remove": []}
+    asyncio.ensure_future(backplane.publish(room, event))
+
+
+def _schedule_presence_flush(r: Room) -> None:
+    if not r.flush_scheduled:
+        r.flush_scheduled = True
+        asyncio.ensure_future(_flush_presence_later(r))
+
+
+async def _flush_presence_later(r: Room) -> None:
+    await asyncio.sleep(PRESENCE_WINDOW)
+    r.flush_scheduled = False
+    if active_rooms.get(r.name) is not r:
+        # the room emptied out (and may have been recreated) in the meantime
+        return
+    try:
+        await flush_presence(r)
+    except Exception:
+        pass
+
+
+def _name_list(names: list) -> str:
+    if len(names) > PRESENCE_NAMES_MAX:
+        shown = names[:PRESENCE_NAMES_MAX]
+        return f"{', '.join(shown)} and {len(names) - len(shown)} others"
+    if len(names) > 1:
+        return f"{', '.join(names[:-1])} and {names[-1]}"
+    return names[0]
+
+
+async def flush_presence(r: Room) -> None:
+    # one merged announcement and one roster delta for everything since the last flush
+    pending_join, pending_leave, anon = r.pending_join, r.pending_leave, r.pending_anon
+    r.pending_join, r.pending_leave, r.pending_anon = {}, {}, 0
+    added = [conn for conn, _ in pending_join.values() if conn in r]
+    joined = [(conn.user or "").strip() for conn, announce in pending_join.values() if announce and conn in r]
+    removed = [name for name, _ in pending_leave.values()]
+    left = [name for name, announce in pending_leave.values() if announce]
+
+    parts = []
+    if joined:
+        parts.append(f"{_name_list(joined)} joined the room")
+    if left:
+        parts.append(f"{_name_list(left)} left the room")
+    if anon:
+        parts.append("A user left the room" if anon == 1 else f"{anon} users left the room")
+    if parts or added or removed:
+        add = [{"name": (e.user or "").strip(), "is_admin": bool(e.is_admin)} for e in added]
+        await backplane.publish(r.name, {"op": "presence", "text": "; ".join(parts), "add": add, "remove": removed})
+
+
+def evict(entry: Connection) -> None:
+    # take a connection that cannot keep up out of its room right away, instead of
+    # waiting for the close handshake to reach its handler
+    entry.closing = True
+    if leave_room(entry.room, entry):
+        note_leave(entry.room, (entry.user or "").strip() or None)
+
+
+async def broadcast(room: str, payload: dict, store: bool = False) -> None:
+    # room-wide messages are relayed to the room's owner worker, which numbers them (seq),
+    # stores chat (store=True) and publishes them to every worker in the room: one
+    # process orders and writes each room's history
+    await backplane.send(backplane.owner(room), room, {"op": "message", "payload": payload, "store": store})
+
+
+def deliver(room: str, payload: dict, exclude: Optional[Connection] = None) -> None:
+    # serialize the payload once and queue the same frame for every local connection in
+    # the room; each connection's writer task delivers it, so a slow reader only delays itself
+    r = active_rooms.get(room)
+    if not r:
+        return
+    # at most one encoding per wire codec in use (JSON text, msgpack)
+    frames = {}
+    for e in r.snapshot():
+        if e is exclude:
+            continue
+        frame = frames.get(e.codec)
+        if frame is None:
+            frame = frames[e.codec] = e.codec.encode(payload)
+        enqueue_frame(e, frame)
+
+
+def send_user_list(entry: Connection) -> None:
+    # full roster snapshot for one client; later changes arrive as users_delta events
+    r = active_rooms.get(entry.room)
+    if r is not None:
+        send_to(entry, {"type": "users", "users": r.users(), "version": r.version})
+
+
+def deliver_presence(r: Room, add: list = (), remove: list = ()) -> None:
+    # bump the room's roster version and send only what changed; a client that sees a
+    # version gap sends {"type": "resync"} to get a fresh snapshot. Deltas are idempotent:
+    # "add" upserts a name and "remove" of an unknown name is a no-op. Versions count
+    # per worker, which is all a client connected to that worker ever sees
+    # a name can leave one worker while it is held on another (a lost username race)
+    remove = [name for name in remove if not r.has_user(name)]
+    if not add and not remove:
+        return
+    r.version += 1
+    payload = {"type": "users_delta", "version": r.version, "add": list(add), "remove": list(remove)}
+    deliver(r.name, payload)
+
+
+def count_in_room(room: str, name: str) -> int:
+    # connections joined under the name in the room, on this worker and on others
+    r = active_rooms.get(room)
+    return len(r.find(name)) + r.remote_count(name) if r else 0
+
+
+async def open_room(room: str) -> Room:
+    # the room's local state, created on its first connection to this worker
+    r = active_rooms.get(room)
+    if r is None:
+        r = active_rooms[room] = Room(room)
+        if backplane.shared:
+            # subscribe before reading history, so nothing published meanwhile is missed
+            backplane.subscribe(room)
+            # ask the workers already in the room for their rosters; they answer while
+            # the scrollback is rebuilt
+            await publish_roster(room, reply=True)
+            await fill_scrollback(room)
+    elif room in backfills:
+        # opened by a connection moments ago; its scrollback is still being rebuilt
+        await asyncio.wait({backfills[room]}, timeout=SCROLLBACK_BACKFILL_TIMEOUT)
+    return r
+
+
+async def publish_roster(room: str, reply: bool = False) -> None:
+    r = active_rooms.get(room)
+    users = r.local_users() if r is not None else []
+    await backplane.publish(room, {"op": "roster", "users": users, "reply": reply})
+
+
+def apply_admin(room: str, event: dict) -> None:
+    # an admin action aimed at a username; each worker applies it to its own connections
+    action = event.get("action")
+    targets = find_in_room(room, event.get("target") or "")
+    for e in targets:
+        if action == "warn":
+            send_to(e, {"user": "system", "text": f"WARNING: {event['text']}"})
+        elif action == "kick":
+            # notify the target then close once the notice is flushed
+            send_to(e, {"user": "system", "text": f"KICK: {event['reason']}"})
+            forget_session(e)
+            close_connection(e)
+            # remove from the live room if present
+            leave_room(room, e)
+        elif action == "open":
+            # instruct the client to open the URL (special payload)
+            send_to(e, {"type": "open", "url": event["url"], "by": event["by"]})
+            # also send a regular chat/system message so clients that only render chat will show it
+            send_to(e, {"user": "system", "text": f"Please open: {event['url']} (requested by {event['by']})"})
+    if action == "kick" and targets:
+        # drop the targets from everyone's roster (the kick itself is announced)
+        note_leave(room, targets[0].user, announce=False)
+
+
+async def handle_event(room: Optional[str], event: dict) -> None:
+    # apply one backplane event, published here or by another worker, to local connections
+    op = event.get("op")
+    origin = event.get("worker")
+    local = origin == backplane.worker_id
+    if room is None:
+        if op == "gone":
+            # a worker went away: its users left every room it served
+            for r in list(active_rooms.values()):
+                gone = r.remote.pop(origin, None)
+                if gone:
+                    names = [u["name"] for u in gone.values()]
+                    deliver(r.name, {"user": "system", "text": f"{_name_list(names)} left the room"})
+                    deliver_presence(r, remove=names)
+        elif op == "members":
+            # seq counters survive only for rooms this worker still owns, and scrollbacks
+            # only for rooms it still hears
+            for name in [n for n in room_seqs if backplane.owner(n) != backplane.worker_id]:
+                del room_seqs[name]
+            for name in [n for n in scrollbacks if not hears_room(n)]:
+                del scrollbacks[name]
+        elif op == "reconnected":
+            # while cut off, other workers may have numbered rooms this one kept numbering
+            room_seqs.clear()
+            for key in users_by_name:
+                backplane.reserve(key)
+            for name in list(active_rooms):
+                await publish_roster(name, reply=True)
+        elif op == "denied":
+            entry = users_by_name.get(event.get("name"))
+            if entry is not None:
+                reject_username(entry)
+        elif op == "drain":
+            # POST /admin/drain on any worker drains them all
+            asyncio.ensure_future(drain())
+        elif op == "undrain":
+            cancel_drain()
+        return
+
+    if op == "message":
+        # this worker owns the room (or did when the message was relayed)
+        payload = dict(event["payload"])
+        payload["seq"] = await next_seq(room)
+        if event.get("store"):
+            message_writer.add(room, payload["user"], payload["text"], time.time(), payload["seq"])
+        await backplane.publish(room, {"op": "chat", "payload": payload, "store": bool(event.get("store"))})
+    elif op == "chat":
+        payload = event["payload"]
+        if hears_room(room):
+            note_seq(room, payload.get("seq"))
+            remember_message(room, payload, event.get("store", True))
+        deliver(room, payload)
+    elif op == "backfill":
+        # a worker opening the room asks its owner for the recent window
+        sb = scrollbacks.get(room)
+        window = [[payload, stored] for payload, stored in sb.messages] if sb is not None else []
+        await backplane.send(origin, room, {"op": "window", "messages": window})
+    elif op == "window":
+        sb = scrollbacks.get(room)
+        if sb is not None and room in active_rooms:
+            entries = [(payload, bool(stored)) for payload, stored in event.get("messages") or ()]
+            sb.merge(entries)
+            for payload, _ in entries:
+                note_seq(room, payload.get("seq"))
+        waiter = backfills.get(room)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+    elif op == "admin":
+        apply_admin(room, event)
+    elif op == "takeover":
+        # the session resumed on another worker; its old connection here leaves quietly
+        holder = users_by_name.get(event.get("name"))
+        if holder is not None and holder.session and holder.session == event.get("session"):
+            holder.session = None
+            if leave_room(holder.room, holder):
+                close_connection(holder)
+                note_leave(holder.room, holder.user, announce=False)
+    elif op == "presence":
+        r = active_rooms.get(room)
+        if r is None:
+            return
+        if not local:
+            r.apply_remote(origin, event.get("add") or [], event.get("remove") or [])
+        if event.get("text"):
+            deliver(room, {"user": "system", "text": event["text"]})
+        if event.get("add") or event.get("remove"):
+            deliver_presence(r, event.get("add") or [], event.get("remove") or [])
+    elif op == "roster" and not local:
+        r = active_rooms.get(room)
+        if r is None:
+            return
+        add, remove = r.set_remote(origin, event.get("users") or [])
+        if add or remove:
+            deliver_presence(r, add, remove)
+        if event.get("reply"):
+            await publish_roster(room)
+
+
+async def run_db(fn, *args):
+    # run a blocking sqlite helper on the DB thread pool and await its result
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(fn, *args))
+
+
+async def drain() -> int:
+    """Move every client off this process without a reconnect stampede.
+
+    Each connection gets a {"type": "reconnect", "delay_ms": n} frame with its own random
+    backoff and is then closed behind whatever it still had queued, in paced batches.
+    Buffered history is flushed before and after. Returns the number of connections.
+    """
+    global draining
+    if draining:
+        return 0
+    draining = True
+    conns = [e for r in list(active_rooms.values()) for e in r.snapshot()]
+    for e in conns:
+        delay = random.uniform(DRAIN_BACKOFF_MIN, DRAIN_BACKOFF_MAX)
+        send_to(e, {"type": "reconnect", "delay_ms": int(delay * 1000)})
+    await message_writer.flush()
+    for i in range(0, len(conns), DRAIN_BATCH):
+        for e in conns[i:i + DRAIN_BATCH]:
+            close_connection(e)
+        await asyncio.sleep(DRAIN_BATCH_INTERVAL)
+    writers = [e.writer for e in conns if not e.writer.done()]
+    if writers:
+        await asyncio.wait(writers, timeout=DRAIN_TIMEOUT)
+    await message_writer.flush()
+    return len(conns)
+
+
+def cancel_drain() -> None:
+    # accept websockets again; clients already told to reconnect still move
+    global draining
+    draining = False
+
+
+def drain_on_sigterm() -> None:
+    # SIGTERM drains first and then runs the handler it replaced (uvicorn's graceful
+    # shutdown); a second SIGTERM during the drain goes straight to that handler.
+    # signal.signal rather than loop.add_signal_handler, because uvicorn installs and
+    # later restores its own handlers with signal.signal
+    if threading.current_thread() is not threading.main_thread():
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+    if not callable(previous):
+        return
+    loop = asyncio.get_running_loop()
+
+    async def drain_then_exit(sig, frame):
+        try:
+            await drain()
+        finally:
+            previous(sig, frame)
+
+    def on_sigterm(sig, frame):
+        if draining:
+            previous(sig, frame)
+        else:
+            loop.call_soon_threadsafe(asyncio.ensure_future, drain_then_exit(sig, frame))
+
+    signal.signal(signal.SIGTERM, on_sigterm)
 
 
 @app.on_event("startup")
-def on_startup():
+async def on_startup():
+    global retention_task, resume_key
     init_db()
+    resume_key = load_resume_key()
+    room_catalog.refresh(force=True)
+    await backplane.start(handle_event)
+    retention_task = asyncio.ensure_future(retention_loop())
+    drain_on_sigterm()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if retention_task is not None:
+        retention_task.cancel()
+    await backplane.close()
+    # history still buffered must reach the DB before the pool goes away
+    await message_writer.close()
+    db_executor.shutdown(wait=True)
+    room_catalog.close()
+    close_db_connections()
 
 
 @app.get("/")
@@ -92,134 +2022,241 @@ def get_index():
 
 
 @app.get("/rooms")
-async def api_list_rooms():
-    return JSONResponse(content={"rooms": list_rooms()})
+async def api_list_rooms(
+    request: Request,
+    after: Optional[str] = None,
+    prefix: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=ROOMS_PAGE_MAX),
+):
+    if after is not None or prefix is not None or limit is not None:
+        # paginated: GET /rooms?prefix=team-&limit=50, then ?after=<next> for the following page
+        after = (after or "").strip().lower()
+        prefix = (prefix or "").strip().lower()
+        rooms, next_cursor = await run_db(room_catalog.page, after, prefix, limit or ROOMS_PAGE_DEFAULT)
+        return JSONResponse(content={"rooms": rooms, "next": next_cursor})
 
+    body, etag = await run_db(rooms_body)
+    # clients revalidate every time; an unchanged list costs a 304 with no body
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
-@app.post("/rooms")
-async def api_create_room(request: Request):
+
+def require_admin_token(request: Request, action: str) -> None:
     # Admin token required (set ADMIN_TOKEN env var on the server)
     admin_token = os.getenv("ADMIN_TOKEN")
     if not admin_token:
-        # creation disabled unless ADMIN_TOKEN configured
-        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Room creation disabled: ADMIN_TOKEN not configured")
+        # admin endpoints are disabled unless ADMIN_TOKEN configured
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"{action} disabled: ADMIN_TOKEN not configured")
 
     header_token = request.headers.get("x-admin-token")
     if header_token != admin_token:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid admin token")
 
+
+@app.post("/rooms")
+async def api_create_room(request: Request):
+    require_admin_token(request, "Room creation")
+
     body = await request.json()
     name = (body.get("name") or "").strip().lower()
     if not name:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Missing room name")
 
-    created = create_room(name)
+    created = await run_db(create_room, name)
     if created:
         return JSONResponse(status_code=status.HTTP_201_CREATED, content={"room": name})
     else:
         return JSONResponse(status_code=status.HTTP_200_OK, content={"room": name, "note": "already exists"})
 
 
+@app.post("/admin/drain")
+async def api_drain(request: Request):
+    # drains every worker; they refuse new websockets until DELETE /admin/drain or a restart
+    require_admin_token(request, "Drain")
+    # only this worker's connections are known here; the others count their own
+    local_connections = sum(len(r) for r in active_rooms.values())
+    await backplane.publish_all({"op": "drain"})
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content={"draining": True, "worker": backplane.worker_id, "local_connections": local_connections},
+    )
+
+
+@app.delete("/admin/drain")
+async def api_cancel_drain(request: Request):
+    require_admin_token(request, "Drain")
+    await backplane.publish_all({"op": "undrain"})
+    return JSONResponse(content={"draining": False})
+
+
+@app.put("/rooms/{room}/retention")
+async def api_set_retention(room: str, request: Request):
+    # body: {"max_age_days": float|null, "max_rows": int|null}; null inherits the global default
+    require_admin_token(request, "Retention policies")
+    room = (room or "").strip().lower()
+    if room not in room_catalog and not await run_db(room_exists, room):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Room '{room}' does not exist")
+
+    body = await request.json()
+    try:
+        max_age_days = float(body["max_age_days"]) if body.get("max_age_days") is not None else None
+        max_rows = int(body["max_rows"]) if body.get("max_rows") is not None else None
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="max_age_days and max_rows must be numbers or null")
+    if (max_age_days is not None and max_age_days < 0) or (max_rows is not None and max_rows < 0):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Retention limits cannot be negative")
+
+    await run_db(set_retention, room, max_age_days, max_rows)
+    return JSONResponse(content={"room": room, "max_age_days": max_age_days, "max_rows": max_rows})
+
+
+@app.get("/rooms/{room}/messages")
+async def api_room_messages(
+    room: str,
+    before: Optional[int] = None,
+    limit: int = Query(HISTORY_PAGE_DEFAULT, ge=1, le=HISTORY_PAGE_MAX),
+):
+    # older history for infinite scroll: pass the returned "next" as ?before= to go further back
+    room = (room or "").strip().lower()
+    if room not in room_catalog and not await run_db(room_exists, room):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Room '{room}' does not exist")
+    messages, next_cursor = await run_db(fetch_messages, room, before, limit)
+    return JSONResponse(content={"room": room, "messages": messages, "next": next_cursor})
+
+
+@app.get("/rooms/{room}/search")
+async def api_room_search(
+    room: str,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(SEARCH_PAGE_DEFAULT, ge=1, le=SEARCH_PAGE_MAX),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+):
+    # ranked full-text search of a room's stored messages; pass "next" as ?offset= for more
+    room = (room or "").strip().lower()
+    if not fts_enabled:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Search unavailable: sqlite built without FTS5")
+    if room not in room_catalog and not await run_db(room_exists, room):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Room '{room}' does not exist")
+    try:
+        results, next_offset = await run_db(search_messages, room, q, limit, offset)
+    except sqlite3.OperationalError:
+        # a query FTS5 still cannot parse is the client's input, not a server fault
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid search query")
+    return JSONResponse(content={"room": room, "q": q, "results": results, "next": next_offset})
+
+
 @app.websocket("/ws/{room}")
 async def websocket_endpoint(ws: WebSocket, room: str):
     # normalize requested room name and ensure it exists in persistent storage
     room = (room or "").strip().lower()
-    if not room_exists(room):
-        # accept then send error and close
+    if draining:
+        # this instance is going away; the client retries and lands on another one
+        # (accepted first so the 1012 close code actually reaches it)
         await ws.accept()
-        await ws.send_text(json.dumps({"user": "system", "text": f"Room '{room}' does not exist"}))
+        await ws.close(code=status.WS_1012_SERVICE_RESTART)
+        return
+    subprotocol, wire_codec = negotiate_codec(ws)
+    # known rooms are answered from the in-memory catalog; only a miss goes to the DB pool
+    if room not in room_catalog and not await run_db(room_exists, room):
+        # accept then send error and close
+        await ws.accept(subprotocol=subprotocol)
+        notice = wire_codec.encode({"user": "system", "text": f"Room '{room}' does not exist"})
+        if wire_codec.binary:
+            await ws.send_bytes(notice)
+        else:
+            await ws.send_text(notice)
         await ws.close()
         return
 
     # accept connection and add to in-memory active room list
-    await ws.accept()
-    if room not in active_rooms:
-        active_rooms[room] = []
-    entry = {"ws": ws, "user": None, "is_admin": False}
-    active_rooms[room].append(entry)
-
-    async def broadcast_user_list(r: str):
-        # build a list of usernames currently active in room r
-        conns = active_rooms.get(r, [])
-        users = []
-        for e in conns:
-            name = (e.get("user") or "").strip()
-            if not name:
-                continue
-            users.append({"name": name, "is_admin": bool(e.get("is_admin"))})
-        payload = {"type": "users", "users": users}
-        for e in list(conns):
-            try:
-                await e["ws"].send_text(json.dumps(payload))
-            except Exception:
-                pass
+    await ws.accept(subprotocol=subprotocol)
+    entry = open_connection(ws, room, wire_codec)
+    (await open_room(room)).add(entry)
 
     try:
         while True:
-            raw = await ws.receive_text()
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
             try:
-                data = json.loads(raw)
+                # binary frames use the negotiated codec, text frames are always JSON
+                if message.get("bytes") is not None:
+                    if not entry.codec.binary:
+                        continue
+                    data = entry.codec.decode(message["bytes"])
+                else:
+                    data = codec.decode(message.get("text") or "")
             except Exception:
-                # ignore malformed JSON
+                # ignore malformed frames
                 continue
 
             if not isinstance(data, dict):
                 continue
 
-            # handle join payloads: { type: 'join', user: 'name' }
+            # handle join payloads: { type: 'join', user: 'name' }, or when resuming
+            # { type: 'join', user: 'name', resume: <token>, last_seq: <n> }
             if data.get("type") == "join":
                 # register the username for this connection and broadcast join to the room
                 username = (data.get("user") or "").strip()
-                if username and not entry.get("user"):
+                if username and not entry.user:
+                    key = normalize_name(username)
+                    nonce = check_resume_token(data.get("resume"), room, username)
+                    resuming = False
+                    if nonce:
+                        # a token resumes its own session, once: whoever still holds the
+                        # name must be that session, and it must not have ended
+                        holder = users_by_name.get(key)
+                        if holder is None or holder.session == nonce:
+                            resuming = await run_db(end_session, nonce)
+                        holder = users_by_name.get(key)
+                        if resuming and holder is not None and holder is not entry and holder.session == nonce:
+                            # after a blip the old connection can still hold the name:
+                            # replace it (quietly, the user is not leaving)
+                            holder.session = None
+                            if leave_room(holder.room, holder):
+                                close_connection(holder)
+                        elif resuming and backplane.name_taken(key):
+                            # the old connection is on another worker: it drops it if it
+                            # is this session, and the release reaches us through the registry
+                            takeover = {"op": "takeover", "name": key, "session": nonce}
+                            await backplane.send(backplane.name_holder(key), room, takeover)
+                            await backplane.wait_released(key, RESUME_TAKEOVER_TIMEOUT)
                     # enforce one user per username globally (case-insensitive)
-                    name_norm = username.strip().lower()
-                    conflict = None
-                    # scan every active connection across all rooms
-                    for r_conns in active_rooms.values():
-                        for e in r_conns:
-                            u = (e.get("user") or "").strip().lower()
-                            if u and u == name_norm:
-                                conflict = e
-                                break
-                        if conflict:
-                            break
-
-                    if conflict:
+                    if not claim_username(entry, username):
                         # inform the joining client that the name is taken (globally) and close
-                        try:
-                            await ws.send_text(json.dumps({"user": "system", "text": f"Username '{username}' is already in use"}))
-                        except Exception:
-                            pass
-                        # remove our placeholder entry and close
-                        try:
-                            if entry in active_rooms.get(room, []):
-                                active_rooms[room].remove(entry)
-                        except Exception:
-                            pass
-                        try:
-                            await ws.close()
-                        except Exception:
-                            pass
+                        send_to(entry, {"user": "system", "text": f"Username '{username}' is already in use"})
+                        # remove our placeholder entry and close once the notice is flushed
+                        leave_room(room, entry)
+                        close_connection(entry)
                         continue
 
-                    entry["user"] = username
-                    # private welcome for the joining client
-                    try:
-                        await ws.send_text(json.dumps({"user": "system", "text": f"{entry['user']} Welcome to the room {room}."}))
-                    except Exception:
-                        pass
-                    # broadcast join announcement to everyone in the room
-                    join_msg = {"user": "system", "text": f"{entry['user']} joined the room"}
-                    for e in list(active_rooms.get(room, [])):
-                        try:
-                            await e["ws"].send_text(json.dumps(join_msg))
-                        except Exception:
-                            pass
-                    # broadcast updated user list to the room
-                    try:
-                        await broadcast_user_list(room)
-                    except Exception:
-                        pass
+                    last_seq = data.get("last_seq")
+                    if resuming and isinstance(last_seq, int) and await replay_since(entry, last_seq):
+                        # only the missed messages: no welcome, history or join announcement.
+                        # The roster gets an (idempotent) re-add; a client that tracks it
+                        # asks for a fresh snapshot with resync
+                        note_join(entry, announce=False)
+                    else:
+                        # private welcome for the joining client
+                        send_to(entry, {"user": "system", "text": f"{entry.user} Welcome to the room {room}."})
+                        # recent messages from the in-memory scrollback
+                        send_history(entry)
+                        # the joining client gets the full roster right away; the join
+                        # announcement and roster delta for the room go out with the next
+                        # presence flush, merged with any other joins/leaves in the window
+                        send_user_list(entry)
+                        note_join(entry)
+                    # what the client needs to resume this session later
+                    entry.session = os.urandom(12).hex()
+                    token = make_resume_token(room, entry.user, entry.session)
+                    send_to(entry, {"type": "session", "token": token, "last_seq": seen_seqs.get(room, 0)})
+                continue
+
+            # client detected a gap in users_delta versions: { type: 'resync' }
+            if data.get("type") == "resync":
+                send_user_list(entry)
                 continue
 
             # client may send { "user": <name>, "text": <message> }
@@ -232,7 +2269,7 @@ async def websocket_endpoint(ws: WebSocket, room: str):
             if text.startswith(">"):
                 cmd_body = text[1:].strip()
                 if not cmd_body:
-                    await ws.send_text(json.dumps({"user": "system", "text": "Empty command"}))
+                    send_to(entry, {"user": "system", "text": "Empty command"})
                     continue
                 parts = cmd_body.split(" ", 1)
                 cmd = parts[0].lower()
@@ -242,138 +2279,80 @@ async def websocket_endpoint(ws: WebSocket, room: str):
                 if cmd == "login":
                     creds = arg.split(" ", 1)
                     if len(creds) < 2:
-                        await ws.send_text(json.dumps({"user": "system", "text": "Usage: >login <username> <password>"}))
+                        send_to(entry, {"user": "system", "text": "Usage: >login <username> <password>"})
                         continue
                     uname, pwd = creds[0].strip(), creds[1].strip()
                     ADMIN_USER = os.getenv("ADMIN_USERNAME")
                     ADMIN_PWD = os.getenv("ADMIN_PASSWORD")
                     if ADMIN_USER and ADMIN_PWD and uname == ADMIN_USER and pwd == ADMIN_PWD:
-                        entry["is_admin"] = True
-                        await ws.send_text(json.dumps({"user": "system", "text": "Admin privileges granted"}))
+                        entry.is_admin = True
+                        send_to(entry, {"user": "system", "text": "Admin privileges granted"})
                     else:
-                        await ws.send_text(json.dumps({"user": "system", "text": "Invalid admin credentials"}))
+                        send_to(entry, {"user": "system", "text": "Invalid admin credentials"})
                     continue
 
                 # other commands require admin
-                if not entry.get("is_admin"):
-                    await ws.send_text(json.dumps({"user": "system", "text": "Unauthorized: admin only command"}))
+                if not entry.is_admin:
+                    send_to(entry, {"user": "system", "text": "Unauthorized: admin only command"})
                     continue
 
                 # >create <room-name>
                 if cmd == "create":
                     room_name = arg.strip()
                     if not room_name:
-                        await ws.send_text(json.dumps({"user": "system", "text": "Usage: >create <room-name>"}))
+                        send_to(entry, {"user": "system", "text": "Usage: >create <room-name>"})
                         continue
-                    created = create_room(room_name)
+                    created = await run_db(create_room, room_name)
                     # announce to admin (private) and to room as admin message if ADMIN_USERNAME is set
-                    await ws.send_text(json.dumps({"user": "system", "text": f"Room '{room_name}' {'created' if created else 'already exists'}"}))
+                    send_to(entry, {"user": "system", "text": f"Room '{room_name}' {'created' if created else 'already exists'}"})
                     # choose announcement username: prefer the admin's live username, then env var, then 'system'
                     env_admin = os.getenv("ADMIN_USERNAME")
-                    ann_user = entry.get("user") if entry.get("is_admin") and entry.get("user") else (env_admin or "system")
+                    ann_user = entry.user if entry.is_admin and entry.user else (env_admin or "system")
                     ann = {"user": ann_user, "text": f"Room '{room_name}' {'created' if created else 'already exists'}"}
-                    for e in list(active_rooms.get(room, [])):
-                        try:
-                            await e["ws"].send_text(json.dumps(ann))
-                        except Exception:
-                            pass
+                    await broadcast(room, ann)
                     continue
 
                 # >warn <username> <message>
                 if cmd == "warn":
                         warn_parts = arg.split(" ", 1)
                         if len(warn_parts) < 1 or not warn_parts[0].strip():
-                            await ws.send_text(json.dumps({"user": "system", "text": "Usage: >warn <username> <message>"}))
+                            send_to(entry, {"user": "system", "text": "Usage: >warn <username> <message>"})
                             continue
                         target = warn_parts[0].strip()
                         warn_msg = warn_parts[1].strip() if len(warn_parts) > 1 and warn_parts[1].strip() else "You have been warned by an admin"
-                        conns = active_rooms.get(room, [])
-                        found = 0
-                        target_norm = target.lower()
-                        # iterate over a copy to avoid mutation issues
-                        for e in list(conns):
-                            u = (e.get("user") or "").strip()
-                            if u.lower() == target_norm:
-                                try:
-                                    await e["ws"].send_text(json.dumps({"user": "system", "text": f"WARNING: {warn_msg}"}))
-                                    found += 1
-                                except Exception:
-                                    # If sending fails, try to close and remove the connection
-                                    try:
-                                        await e["ws"].close()
-                                    except Exception:
-                                        pass
-                                    try:
-                                        conns.remove(e)
-                                    except ValueError:
-                                        pass
-                        # after potential removals, broadcast updated user list
-                        try:
-                            await broadcast_user_list(room)
-                        except Exception:
-                            pass
+                        # targets may be connected to any worker
+                        found = count_in_room(room, target)
+                        await backplane.publish(room, {"op": "admin", "action": "warn", "target": target, "text": warn_msg})
                         # confirm to the admin who issued the warn
-                        confirm_user = entry.get("user") if entry.get("is_admin") and entry.get("user") else "system"
-                        await ws.send_text(json.dumps({"user": "system", "text": f"Warned {found} connection(s) for {target}."}))
+                        confirm_user = entry.user if entry.is_admin and entry.user else "system"
+                        send_to(entry, {"user": "system", "text": f"Warned {found} connection(s) for {target}."})
                         # also announce to room as admin message if applicable
                         if found:
                             env_admin = os.getenv("ADMIN_USERNAME")
-                            ann_user = entry.get("user") if entry.get("is_admin") and entry.get("user") else (env_admin or "system")
+                            ann_user = entry.user if entry.is_admin and entry.user else (env_admin or "system")
                             ann = {"user": ann_user, "text": f"Admin warned {target}: {warn_msg}"}
-                            for e in list(active_rooms.get(room, [])):
-                                try:
-                                    await e["ws"].send_text(json.dumps(ann))
-                                except Exception:
-                                    pass
+                            await broadcast(room, ann)
                         continue
 
                 # >kick <username> [reason]
                 if cmd == "kick":
                         kick_parts = arg.split(" ", 1)
                         if len(kick_parts) < 1 or not kick_parts[0].strip():
-                            await ws.send_text(json.dumps({"user": "system", "text": "Usage: >kick <username> <reason?>"}))
+                            send_to(entry, {"user": "system", "text": "Usage: >kick <username> <reason?>"})
                             continue
                         target = kick_parts[0].strip()
                         reason = kick_parts[1].strip() if len(kick_parts) > 1 and kick_parts[1].strip() else "kicked by admin"
-                        conns = active_rooms.get(room, [])
-                        removed = 0
-                        target_norm = target.lower()
-                        # iterate over a copy so we can modify the original list
-                        for e in list(conns):
-                            u = (e.get("user") or "").strip()
-                            if u.lower() == target_norm:
-                                try:
-                                    # notify the target then close
-                                    await e["ws"].send_text(json.dumps({"user": "system", "text": f"KICK: {reason}"}))
-                                    await e["ws"].close()
-                                except Exception:
-                                    try:
-                                        await e["ws"].close()
-                                    except Exception:
-                                        pass
-                                # remove from the live list if present
-                                try:
-                                    conns.remove(e)
-                                except ValueError:
-                                    pass
-                                removed += 1
+                        # every worker kicks its own connections of the target
+                        removed = count_in_room(room, target)
+                        await backplane.publish(room, {"op": "admin", "action": "kick", "target": target, "reason": reason})
                         # confirm to admin
-                        await ws.send_text(json.dumps({"user": "system", "text": f"Kicked {removed} connection(s) for {target}."}))
+                        send_to(entry, {"user": "system", "text": f"Kicked {removed} connection(s) for {target}."})
                         # broadcast a room-wide announcement about the kick
                         if removed:
                             env_admin = os.getenv("ADMIN_USERNAME")
-                            kick_user = entry.get("user") if entry.get("is_admin") and entry.get("user") else (env_admin or "system")
+                            kick_user = entry.user if entry.is_admin and entry.user else (env_admin or "system")
                             kick_announce = {"user": kick_user, "text": f"{target} was kicked by admin ({reason})"}
-                            for e in list(active_rooms.get(room, [])):
-                                try:
-                                    await e["ws"].send_text(json.dumps(kick_announce))
-                                except Exception:
-                                    pass
-                            # broadcast updated user list now that targets were removed
-                            try:
-                                await broadcast_user_list(room)
-                            except Exception:
-                                pass
+                            await broadcast(room, kick_announce)
                         continue
 
                 # >rainbow [on|off]
@@ -384,21 +2363,13 @@ async def websocket_endpoint(ws: WebSocket, room: str):
                     if arg_l in ("off", "0", "false", "no"):
                         on = False
                     env_admin = os.getenv("ADMIN_USERNAME")
-                    ann_user = entry.get("user") if entry.get("is_admin") and entry.get("user") else (env_admin or "system")
+                    ann_user = entry.user if entry.is_admin and entry.user else (env_admin or "system")
                     payload = {"type": "rainbow", "on": on, "by": ann_user}
                     # send rainbow control message to everyone in the room
-                    for e in list(active_rooms.get(room, [])):
-                        try:
-                            await e["ws"].send_text(json.dumps(payload))
-                        except Exception:
-                            pass
+                    await broadcast(room, payload)
                     # announce as an admin chat message
                     ann = {"user": ann_user, "text": f"Admin {'enabled' if on else 'disabled'} rainbow usernames"}
-                    for e in list(active_rooms.get(room, [])):
-                        try:
-                            await e["ws"].send_text(json.dumps(ann))
-                        except Exception:
-                            pass
+                    await broadcast(room, ann)
                     continue
 
                 # >open <url> <username>
@@ -406,7 +2377,7 @@ async def websocket_endpoint(ws: WebSocket, room: str):
                     # syntax check
                     parts_open = arg.split(" ", 1)
                     if len(parts_open) < 2 or not parts_open[0].strip() or not parts_open[1].strip():
-                        await ws.send_text(json.dumps({"user": "system", "text": "Usage: >open <url> <username>"}))
+                        send_to(entry, {"user": "system", "text": "Usage: >open <url> <username>"})
                         continue
                     url_raw = parts_open[0].strip()
                     target = parts_open[1].strip()
@@ -415,31 +2386,10 @@ async def websocket_endpoint(ws: WebSocket, room: str):
                         url = "http://" + url_raw
                     else:
                         url = url_raw
-                    conns = active_rooms.get(room, [])
-                    targeted = 0
-                    target_norm = target.lower()
                     env_admin = os.getenv("ADMIN_USERNAME")
-                    ann_user = entry.get("user") if entry.get("is_admin") and entry.get("user") else (env_admin or "system")
-                    # iterate over a copy so we can safely modify
-                    for e in list(conns):
-                        u = (e.get("user") or "").strip()
-                        if u and u.lower() == target_norm:
-                            try:
-                                # instruct the client to open the URL (special payload)
-                                await e["ws"].send_text(json.dumps({"type": "open", "url": url, "by": ann_user}))
-                                # also send a regular chat/system message so clients that only render chat will show it
-                                await e["ws"].send_text(json.dumps({"user": "system", "text": f"Please open: {url} (requested by {ann_user})"}))
-                                targeted += 1
-                            except Exception:
-                                # if send fails, attempt to close and remove
-                                try:
-                                    await e["ws"].close()
-                                except Exception:
-                                    pass
-                                try:
-                                    conns.remove(e)
-                                except ValueError:
-                                    pass
+                    ann_user = entry.user if entry.is_admin and entry.user else (env_admin or "system")
+                    targeted = count_in_room(room, target)
+                    await backplane.publish(room, {"op": "admin", "action": "open", "target": target, "url": url, "by": ann_user})
                     # attempt to open on server as well (per request to use webbrowser)
                     try:
                         if targeted:
@@ -447,55 +2397,37 @@ async def websocket_endpoint(ws: WebSocket, room: str):
                     except Exception:
                         pass
                     # confirm to admin
-                    await ws.send_text(json.dumps({"user": "system", "text": f"Open request sent to {targeted} connection(s) for {target}."}))
+                    send_to(entry, {"user": "system", "text": f"Open request sent to {targeted} connection(s) for {target}."})
                     # announce to room as admin message if any targeted
                     if targeted:
                         ann = {"user": ann_user, "text": f"Admin opened {url} for {target}"}
-                        for e in list(active_rooms.get(room, [])):
-                            try:
-                                await e["ws"].send_text(json.dumps(ann))
-                            except Exception:
-                                pass
+                        await broadcast(room, ann)
                     continue
 
-                await ws.send_text(json.dumps({"user": "system", "text": f"Unknown command: {cmd}"}))
+                send_to(entry, {"user": "system", "text": f"Unknown command: {cmd}"})
                 continue
 
             # regular message broadcast
-            payload = {"user": entry.get("user") or username or "anon", "text": text}
-            conns = list(active_rooms.get(room, []))
-            for e in conns:
-                try:
-                    await e["ws"].send_text(json.dumps(payload))
-                except Exception:
-                    pass
-    except WebSocketDisconnect:
-        # remove the websocket entry from the room list and announce leave
-        leaving_name = None
-        if room in active_rooms:
-            for e in list(active_rooms[room]):
-                if e.get("ws") is ws:
-                    try:
-                        leaving_name = (e.get("user") or "").strip() or None
-                        active_rooms[room].remove(e)
-                    except ValueError:
-                        pass
-            # announce to remaining users in the room that someone left
-            if room in active_rooms and active_rooms.get(room):
-                try:
-                    leave_msg = {"user": "system", "text": f"{leaving_name or 'A user'} left the room"}
-                    for e in list(active_rooms.get(room, [])):
-                        try:
-                            await e["ws"].send_text(json.dumps(leave_msg))
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
-                # broadcast updated user list now that someone left
-                try:
-                    await broadcast_user_list(room)
-                except Exception:
-                    pass
-            # if no more connections, remove the room key
-            if room in active_rooms and not active_rooms[room]:
-                del active_rooms[room]
+            payload = {"user": entry.user or username or "anon", "text": text}
+            await broadcast(room, payload, store=True)
+    except WebSocketDisconnect as exc:
+        closed = exc.code in (1000, 1001) and not entry.closing
+        if closed:
+            # the client closed on purpose (left the room or the page), not a blip
+            forget_session(entry)
+        # remove the connection from the room and announce leave
+        # connections that were already taken out (kicked, evicted, rejected name)
+        # have been announced elsewhere
+        if leave_room(room, entry):
+            name = (entry.user or "").strip() or None
+            if name and entry.session and not closed and RESUME_GRACE > 0:
+                # dropped: off the roster now, announced only if it does not resume
+                note_leave(room, name, announce=False)
+                asyncio.get_running_loop().call_later(RESUME_GRACE, announce_dropped, room, name)
+            else:
+                note_leave(room, name)
+    finally:
+        # never leave a dead connection registered, whatever ended the loop
+        leave_room(room, entry)
+        # stop this connection's writer; anything still queued is for a closed socket
+        entry.writer.cancel()
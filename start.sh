@@ -12,6 +12,21 @@ created = create_room("lobby")
 print("lobby ensured (created=" + str(created) + ")")
 PY
 
+# Several workers (WEB_CONCURRENCY > 1) share room events through the backplane broker;
+# workers retry until it is listening, so it does not need to be up first. The broker is
+# restarted whenever it exits (for as long as the server runs); workers run alone, and
+# log a warning, until it is back.
+WORKERS="${WEB_CONCURRENCY:-1}"
+if [ "$WORKERS" -gt 1 ]; then
+  export BACKPLANE=socket
+  (
+    while kill -0 $$ 2>/dev/null; do
+      python broker.py || echo "broker exited with status $?; restarting" >&2
+      sleep 1
+    done
+  ) &
+fi
+
 # Start the server on the port Render provides (default to 8000 if not set)
 # --proxy-headers helps when behind a proxy/load balancer
-exec uvicorn server:app --host 0.0.0.0 --port "${PORT:-8000}" --proxy-headers
+exec uvicorn server:app --host 0.0.0.0 --port "${PORT:-8000}" --proxy-headers --workers "$WORKERS"